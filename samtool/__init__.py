@@ -1,2 +1,10 @@
-from .app_gradio import main as main_gradio
 from .utils import delete_label, label_exists, retrieve_label, save_label
+
+
+def __getattr__(name):
+    # the app pulls in gradio and torch, so only import it when it is asked for
+    if name == "main_gradio":
+        from .app_gradio import main as main_gradio
+
+        return main_gradio
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
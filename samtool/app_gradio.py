@@ -1,25 +1,73 @@
 import argparse
+import atexit
+import functools
 import os
+import time
 
 import gradio as gr
 import numpy as np
 
+from samtool.dedup import DuplicateIndex
+from samtool.embeddings import EmbeddingCache
+from samtool.inference import InferenceConfig
+from samtool.leases import Lease, open_coordinator
+from samtool.memory import MemoryBudget
 from samtool.sammer import FileSeeker, Sammer
-
-
-def create_app(imagedir: str, labeldir: str, annotations: str):
+from samtool.storage import SQLITE_EXTENSIONS, label_key
+from samtool.weights import add_arguments as add_checkpoint_arguments
+from samtool.worker import STALE, InferenceWorker
+
+
+def create_app(
+    imagedir: str,
+    labeldir: str,
+    annotations: str,
+    dedup: None | str = None,
+    preview_scale: float = 0.25,
+    inference: None | InferenceConfig = None,
+    checkpoint: None | str = None,
+    cache_dir: None | str = None,
+    embedding_cache: None | str = None,
+    lease: None | Lease = None,
+    memory_budget: int = 2 << 30,
+    concurrency: int = 4,
+):
     with gr.Blocks() as app:
-        seeker = FileSeeker(imagedir, labeldir, annotations)
+        seeker = FileSeeker(
+            imagedir,
+            labeldir,
+            annotations,
+            duplicate_index=DuplicateIndex.load(dedup) if dedup is not None else None,
+            lease=lease,
+        )
+
+        # each instance keeps its own embeddings, since no two instances see the same images
+        if embedding_cache is not None and lease is not None:
+            embedding_cache = os.path.join(embedding_cache, lease.owner)
+        # the image, embedding and undo caches share one budget
+        memory = MemoryBudget(memory_budget)
         sam = Sammer(
             seeker.all_labels,
             imagedir,
             labeldir,
+            inference=inference,
+            warmup=inference is not None and inference.compile,
+            checkpoint=checkpoint,
+            cache_dir=cache_dir,
+            background_load=True,
+            embedding_cache=EmbeddingCache(embedding_cache, budget=memory),
+            memory_budget=memory,
+            # every request the queue runs at once may still be sending a render
+            render_buffers=concurrency + 1,
         )
 
-        # hacky asynchronous update thing
-        checkbox_asyncer = gr.Checkbox(value=False, visible=False, show_label=False)
+        # all sam work goes through one thread, handlers only await it
+        worker = InferenceWorker()
 
         """BUILD INTERFACE"""
+        # the model loads in the background, the first image waits for it
+        markdown_status = gr.Markdown(visible=False)
+
         # annotation tools
         with gr.Row():
             with gr.Column(scale=1):
@@ -65,14 +113,17 @@ def create_app(imagedir: str, labeldir: str, annotations: str):
                         value="Reset Label", variant="secondary"
                     )
                     button_reset_all = gr.Button(value="Reset All", variant="secondary")
+                    button_undo = gr.Button(value="Undo", variant="secondary")
+                    button_copy_neighbour = gr.Button(
+                        value="Use Neighbour Label",
+                        variant="secondary",
+                        visible=dedup is not None,
+                    )
+                    button_propagate = gr.Button(value="Propagate", variant="secondary")
 
-        # warning for crayon mode
-        textbox_crayon = gr.Textbox(
-            label="WARNING",
-            value="""CRAYON MODE IS HIGHLY EXPERIMENTAL AND BUGGY! ACCURATE PERFORMANCE IS NOT GUARANTEED!
-            That said, what you see on the right image is accurate, so play around if you must.""",
-            lines=2,
-            visible=False,
+        # crayon strokes can be snapped to the object they cover
+        checkbox_snap = gr.Checkbox(
+            value=False, label="Snap Strokes To Objects", visible=False
         )
 
         with gr.Row():
@@ -103,8 +154,26 @@ def create_app(imagedir: str, labeldir: str, annotations: str):
                 value="Accept", variant="primary", visible=False
             )
 
+        # memory usage of the caches
+        with gr.Accordion("Memory", open=False):
+            textbox_memory = gr.Textbox(show_label=False, interactive=False, lines=6)
+            button_memory = gr.Button(value="Refresh", variant="secondary")
+
+        # scale of the image in the normal display, clicks on a preview are scaled back up
+        state_scale = gr.State(1.0)
+
         """DEFINE INTERFACE FUNCTIONALITY"""
 
+        def full_scale(fn):
+            """Marks the normal display as full resolution, for handlers that show a full resolution image in it."""
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                result = fn(*args, **kwargs)
+                return (*result, 1.0) if isinstance(result, tuple) else (result, 1.0)
+
+            return wrapper
+
         # filenumber change
         dropdown_filenumber.change(
             fn=lambda i: seeker.all_images[int(i)],
@@ -112,11 +181,17 @@ def create_app(imagedir: str, labeldir: str, annotations: str):
             outputs=dropdown_filename,
         )
 
+        @worker.offload
+        @full_scale
         def surrogate_reset(filename, mode):
             """Resets everything because the filename has changed."""
-            done_labels = len(os.listdir(labeldir))
-            progress_string = f"{done_labels} of {len(seeker.all_images)} completed."
+            progress_string = seeker.progress()
             filenumber = str(seeker.all_images.index(filename))
+            if seeker.lease is not None:
+                filenumber = gr.Dropdown.update(
+                    choices=[str(i) for i in range(len(seeker.all_images))],
+                    value=filenumber,
+                )
             base_image = sam.reset(filename)
             comp_image = sam.get_comp_image(filename)
 
@@ -143,40 +218,53 @@ def create_app(imagedir: str, labeldir: str, annotations: str):
                 display_complete,
                 progress,
                 dropdown_filenumber,
+                state_scale,
             ],
         )
 
+        def seek(filename, ascend, unlabelled_only):
+            filename = seeker.file_increment(
+                ascend=ascend, unlabelled_only=unlabelled_only, filename=filename
+            )
+            if seeker.lease is None:
+                return filename
+
+            # the lease may have grown, so the choices grow with it
+            return gr.Dropdown.update(choices=seeker.all_images, value=filename)
+
         # file increment decrement operators
         button_prev_unlabelled.click(
-            fn=lambda f: seeker.file_increment(
-                ascend=False, unlabelled_only=True, filename=f
-            ),
+            fn=lambda f: seek(f, ascend=False, unlabelled_only=True),
             inputs=dropdown_filename,
             outputs=dropdown_filename,
         )
         button_prev.click(
-            fn=lambda f: seeker.file_increment(
-                ascend=False, unlabelled_only=False, filename=f
-            ),
+            fn=lambda f: seek(f, ascend=False, unlabelled_only=False),
             inputs=dropdown_filename,
             outputs=dropdown_filename,
         )
         button_next.click(
-            fn=lambda f: seeker.file_increment(
-                ascend=True, unlabelled_only=False, filename=f
-            ),
+            fn=lambda f: seek(f, ascend=True, unlabelled_only=False),
             inputs=dropdown_filename,
             outputs=dropdown_filename,
         )
         button_next_unlabelled.click(
-            fn=lambda f: seeker.file_increment(
-                ascend=True, unlabelled_only=True, filename=f
-            ),
+            fn=lambda f: seek(f, ascend=True, unlabelled_only=True),
             inputs=dropdown_filename,
             outputs=dropdown_filename,
         )
 
+        def check_lease(filename):
+            """Stops any handler that writes to the store once this instance lost the image."""
+            if not seeker.owns(filename):
+                raise gr.Error(
+                    "This image is now leased to another instance, move on to the next one."
+                )
+
+        @worker.offload
+        @full_scale
         def surrogate_clear_comp_mask(filename, label):
+            check_lease(filename)
             sam.clear_comp_mask(filename, label)
             base_image = sam.reset(filename, compute_embeddings=False)
             comp_image = sam.get_comp_image(filename)
@@ -184,27 +272,142 @@ def create_app(imagedir: str, labeldir: str, annotations: str):
 
         # clear the selection image
         button_reset_selection.click(
-            fn=sam.clear_coords_validity_part, outputs=display_partial_normal
+            fn=worker.offload(full_scale(sam.clear_coords_validity_part)),
+            outputs=[display_partial_normal, state_scale],
         )
         # clear only the labels in the complete image
         button_reset_label.click(
-            fn=lambda f, l: surrogate_clear_comp_mask(filename=f, label=l),
+            fn=surrogate_clear_comp_mask,
             inputs=[dropdown_filename, radio_label],
-            outputs=[display_partial_normal, display_complete],
+            outputs=[display_partial_normal, display_complete, state_scale],
         )
         # clear everything
         button_reset_all.click(
-            fn=lambda f: surrogate_clear_comp_mask(filename=f, label=None),
+            fn=functools.partial(surrogate_clear_comp_mask, label=None),
+            inputs=dropdown_filename,
+            outputs=[display_partial_normal, display_complete, state_scale],
+        )
+
+        @worker.offload
+        @full_scale
+        def surrogate_undo(filename):
+            check_lease(filename)
+            if not sam.undo(filename):
+                raise gr.Error("Nothing to undo for this image.")
+            base_image = sam.reset(filename, compute_embeddings=False)
+            comp_image = sam.get_comp_image(filename)
+            return base_image, comp_image
+
+        # revert the last edit to the complete image
+        button_undo.click(
+            fn=surrogate_undo,
+            inputs=dropdown_filename,
+            outputs=[display_partial_normal, display_complete, state_scale],
+        )
+
+        def model_status():
+            """Shows that the model is loading until it is ready, or that it failed to load."""
+            if not sam.model_ready:
+                yield gr.update(value="Loading the SAM model...", visible=True)
+                while not sam.model_ready:
+                    time.sleep(0.5)
+            try:
+                sam.predictor
+            except RuntimeError:
+                yield gr.update(
+                    value="The SAM model failed to load, see the console for the error.",
+                    visible=True,
+                )
+            else:
+                yield gr.update(visible=False)
+
+        app.load(fn=model_status, outputs=markdown_status)
+
+        # show the memory usage per cache
+        button_memory.click(fn=memory.report, outputs=textbox_memory)
+
+        @worker.offload
+        @full_scale
+        def surrogate_copy_neighbour(filename):
+            check_lease(filename)
+            neighbour = seeker.labelled_neighbour(filename)
+            if neighbour is None or not sam.copy_comp_mask(filename, neighbour):
+                raise gr.Error("No labelled near-duplicate found for this image.")
+            base_image = sam.reset(filename, compute_embeddings=False)
+            comp_image = sam.get_comp_image(filename)
+            return base_image, comp_image
+
+        # start from the label of the nearest labelled near-duplicate
+        button_copy_neighbour.click(
+            fn=surrogate_copy_neighbour,
             inputs=dropdown_filename,
-            outputs=[display_partial_normal, display_complete],
+            outputs=[display_partial_normal, display_complete, state_scale],
         )
 
-        # normal update
-        def update_prediction_normal(event: gr.SelectData, validity, label):
-            sam.add_coords_validity(np.array(event.index), validity)
-            return sam.update_part_image(label)
+        @worker.offload
+        @full_scale
+        def surrogate_propagate(filename):
+            check_lease(filename)
+            # never replace work that is already there
+            if seeker.store.exists(label_key(filename), sam.num_labels):
+                raise gr.Error(
+                    "This image already has a label, use Reset All to propagate into it."
+                )
+
+            source = seeker.previous_frame(filename)
+            if source is None or not sam.propagate(filename, source):
+                raise gr.Error("The previous frame has no label to propagate.")
+            base_image = sam.reset(filename, compute_embeddings=False)
+            comp_image = sam.get_comp_image(filename)
+            return base_image, comp_image
+
+        # propose a label using the label of the previous image
+        button_propagate.click(
+            fn=surrogate_propagate,
+            inputs=dropdown_filename,
+            outputs=[display_partial_normal, display_complete, state_scale],
+        )
 
+        # normal update, streams a cheap preview first and the full resolution image after
+        async def update_prediction_normal(
+            event: gr.SelectData, validity, label, shown_scale
+        ):
+            # the click is in the pixels of whatever was displayed, possibly a preview
+            coord = np.array(event.index) / shown_scale
+            ticket = worker.ticket("part")
+            await worker.run(sam.add_coords_validity, coord, validity)
+
+            # rapid clicks coalesce, the newest click predicts with all coords anyway
+            if (
+                await worker.run_if_latest("part", ticket, sam.decode_part_mask)
+                is STALE
+            ):
+                yield gr.update(), gr.update()
+                return
+
+            # the preview is drawn from the decoder output, before the full resolution upsample
+            preview = await worker.run_if_latest(
+                "part", ticket, sam.render_part_preview, label, preview_scale
+            )
+            if preview is STALE:
+                yield gr.update(), gr.update()
+                return
+            yield preview, preview_scale
+
+            def full_resolution():
+                sam.upsample_part_mask()
+                return sam.render_part_image(label)
+
+            image = await worker.run_if_latest("part", ticket, full_resolution)
+            if image is STALE:
+                yield gr.update(), gr.update()
+                return
+            yield image, 1.0
+
+        @worker.offload
+        @full_scale
         def surrogate_part_to_comp_mask(filename, label, mode, add):
+            check_lease(filename)
             sam.part_to_comp_mask(filename, label, add=add)
             base_image = sam.reset(filename, compute_embeddings=False)
             comp_image = sam.get_comp_image(filename)
@@ -213,31 +416,51 @@ def create_app(imagedir: str, labeldir: str, annotations: str):
         # normal mode functionality
         display_partial_normal.select(
             fn=update_prediction_normal,
-            inputs=[checkbox_validity, radio_label],
-            outputs=display_partial_normal,
+            inputs=[checkbox_validity, radio_label, state_scale],
+            outputs=[display_partial_normal, state_scale],
         )
         button_accept_normal.click(
-            fn=lambda x, l, m: surrogate_part_to_comp_mask(x, l, m, add=True),
+            fn=functools.partial(surrogate_part_to_comp_mask, add=True),
             inputs=[dropdown_filename, radio_label, radio_mode],
-            outputs=[display_partial_normal, display_partial_crayon, display_complete],
+            outputs=[
+                display_partial_normal,
+                display_partial_crayon,
+                display_complete,
+                state_scale,
+            ],
         )
         button_negate_normal.click(
-            fn=lambda x, l, m: surrogate_part_to_comp_mask(x, l, m, add=False),
+            fn=functools.partial(surrogate_part_to_comp_mask, add=False),
             inputs=[dropdown_filename, radio_label, radio_mode],
-            outputs=[display_partial_normal, display_partial_crayon, display_complete],
+            outputs=[
+                display_partial_normal,
+                display_partial_crayon,
+                display_complete,
+                state_scale,
+            ],
         )
 
         # instant update
-        def update_prediction_instant(
-            event: gr.SelectData, filename, label, validity, toggle
-        ):
+        def commit_instant(coord, filename, label, validity):
+            check_lease(filename)
+
             # always work in valid selection mode, and use validity to determine whether to negate
-            sam.add_coords_validity(np.array(event.index), True)
-            sam.update_part_image(label)
+            sam.add_coords_validity(coord, True)
+            sam.predict_part_mask()
             sam.part_to_comp_mask(filename, label, add=validity)
 
-            # toggle the async function
-            return not toggle
+        async def update_prediction_instant(
+            event: gr.SelectData, filename, label, validity
+        ):
+            # every click is committed, but only the newest one redraws the complete image
+            ticket = worker.ticket("comp")
+            await worker.run(
+                commit_instant, np.array(event.index), filename, label, validity
+            )
+            comp_image = await worker.run_if_latest(
+                "comp", ticket, sam.get_comp_image, filename
+            )
+            return gr.update() if comp_image is STALE else comp_image
 
         # instant mode functionality
         display_partial_instant.select(
@@ -246,17 +469,25 @@ def create_app(imagedir: str, labeldir: str, annotations: str):
                 dropdown_filename,
                 radio_label,
                 checkbox_validity,
-                checkbox_asyncer,
             ],
-            outputs=checkbox_asyncer,
+            outputs=display_complete,
         )
 
         # crayon update
-        def crayon_update(drawing: dict, filename, label, validity):
-            mask = drawing["mask"][..., 0] == 255
-            sam.part_mask = mask
+        @worker.offload
+        def crayon_update(drawing: dict, filename, label, validity, snap):
+            check_lease(filename)
+
+            # only a single channel of the sketch is needed
+            stroke = drawing["mask"][..., 0] == 255
+            if snap:
+                sam.snap_stroke(stroke)
+            else:
+                sam.set_part_mask(stroke)
             sam.part_to_comp_mask(filename, label, add=validity)
-            return sam.get_comp_image(filename)
+
+            # a fresh base image clears the sketch, so accepted strokes aren't sent and merged again
+            return sam.base_image, sam.get_comp_image(filename)
 
         # crayon only has one button
         button_accept_crayon.click(
@@ -266,22 +497,14 @@ def create_app(imagedir: str, labeldir: str, annotations: str):
                 dropdown_filename,
                 radio_label,
                 checkbox_validity,
+                checkbox_snap,
             ],
-            outputs=display_complete,
-        )
-
-        # hacky async update
-        def async_update_prediction_instant(filename):
-            return sam.get_comp_image(filename)
-
-        # async hook
-        checkbox_asyncer.change(
-            fn=async_update_prediction_instant,
-            inputs=dropdown_filename,
-            outputs=display_complete,
+            outputs=[display_partial_crayon, display_complete],
         )
 
         # whether normal, instant, or crayon mode
+        @worker.offload
+        @full_scale
         def mode_change(filename, mode):
             sam.clear_coords_validity_part()
 
@@ -338,7 +561,7 @@ def create_app(imagedir: str, labeldir: str, annotations: str):
                 button_accept_normal,
                 button_negate_normal,
                 button_accept_crayon,
-                textbox_crayon,
+                checkbox_snap,
                 button_reset_selection,
                 display_partial_normal,
                 display_partial_instant,
@@ -346,6 +569,7 @@ def create_app(imagedir: str, labeldir: str, annotations: str):
                 display_partial_normal,
                 display_partial_instant,
                 display_partial_crayon,
+                state_scale,
             ],
         )
 
@@ -360,7 +584,47 @@ def main():
     parser.add_argument("--imagedir", required=True)
     parser.add_argument("--labeldir", required=True)
     parser.add_argument("--annotations", required=True)
+    parser.add_argument("--dedup", default=None)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--preview-scale", type=float, default=0.25)
+    parser.add_argument("--embedding-cache", default=None)
+    parser.add_argument("--memory-budget-mb", type=int, default=2048)
     parser.add_argument("--share", default=False, action="store_true")
+    parser.add_argument("--leases", default=None)
+    parser.add_argument("--instance", default=None)
+    parser.add_argument("--lease-batch", type=int, default=32)
+    parser.add_argument("--lease-ttl", type=float, default=600.0)
+    InferenceConfig.add_arguments(parser)
+    add_checkpoint_arguments(parser)
     args = parser.parse_args()
 
-    create_app(args.imagedir, args.labeldir, args.annotations).launch(share=args.share)
+    # instances sharing a leases file split the images between them
+    lease = None
+    if args.leases is not None:
+        # the sqlite store uses wal, which needs shared memory that network filesystems don't have
+        if args.labeldir.endswith(SQLITE_EXTENSIONS):
+            parser.error(
+                "--leases needs a png label directory, a sqlite label store can't be shared over network storage."
+            )
+        lease = Lease(
+            open_coordinator(args.leases),
+            owner=args.instance,
+            batch_size=args.lease_batch,
+            ttl=args.lease_ttl,
+        )
+        atexit.register(lease.close)
+
+    create_app(
+        args.imagedir,
+        args.labeldir,
+        args.annotations,
+        dedup=args.dedup,
+        preview_scale=args.preview_scale,
+        inference=InferenceConfig.from_args(args),
+        checkpoint=args.checkpoint,
+        cache_dir=args.cache_dir,
+        embedding_cache=args.embedding_cache,
+        lease=lease,
+        memory_budget=args.memory_budget_mb << 20,
+        concurrency=args.concurrency,
+    ).queue(concurrency_count=args.concurrency).launch(share=args.share)
@@ -0,0 +1,129 @@
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+from segment_anything import SamPredictor
+
+from samtool.inference import InferenceConfig
+from samtool.sammer import load_predictor
+
+
+def mask_iou(mask_a: np.ndarray, mask_b: np.ndarray) -> float:
+    """Intersection over union of two boolean masks, two empty masks have an IoU of 1."""
+    union = np.logical_or(mask_a, mask_b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(mask_a, mask_b).sum() / union)
+
+
+def _timed_set_image(
+    config: InferenceConfig, predictor: SamPredictor, image: np.ndarray
+) -> float:
+    """Computes the embeddings for an image and returns the time taken in seconds."""
+    if config.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    config.set_image(predictor, image)
+    if config.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def _predict(
+    config: InferenceConfig, predictor: SamPredictor, point: np.ndarray
+) -> np.ndarray:
+    """Predicts a single mask from a single positive point."""
+    with config.context():
+        masks, _, _ = predictor.predict(
+            point_coords=point[None],
+            point_labels=np.array([1]),
+            multimask_output=False,
+        )
+    return masks[0]
+
+
+def benchmark(
+    images_path: str,
+    filenames: list[str],
+    candidate: InferenceConfig,
+    num_points: int = 4,
+) -> dict[str, float]:
+    """Compares an inference config against plain fp32 inference.
+
+    Both models see the same images and the same randomly sampled point prompts,
+    the drift is measured as the IoU between the masks they produce.
+
+    Args:
+        images_path (str): directory of the images on the disk
+        filenames (list[str]): names of the images to benchmark on
+        candidate (InferenceConfig): the config to evaluate
+        num_points (int): number of point prompts per image
+
+    Returns:
+        dict[str, float]: mean and min IoU, and mean encoder latency of both configs
+    """
+    reference = InferenceConfig(device=candidate.device)
+    ref_predictor = load_predictor(reference)
+    cand_predictor = load_predictor(candidate)
+    candidate.warmup(cand_predictor)
+    reference.warmup(ref_predictor)
+
+    rng = np.random.default_rng(0)
+    ious, ref_times, cand_times = [], [], []
+    for filename in filenames:
+        image = cv2.imread(os.path.join(images_path, filename))
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+        ref_times.append(_timed_set_image(reference, ref_predictor, image))
+        cand_times.append(_timed_set_image(candidate, cand_predictor, image))
+
+        points = rng.uniform((0, 0), image.shape[1::-1], size=(num_points, 2))
+        for point in points:
+            ious.append(
+                mask_iou(
+                    _predict(reference, ref_predictor, point),
+                    _predict(candidate, cand_predictor, point),
+                )
+            )
+
+    return {
+        "mean_iou": float(np.mean(ious)),
+        "min_iou": float(np.min(ious)),
+        "reference_latency": float(np.mean(ref_times)),
+        "candidate_latency": float(np.mean(cand_times)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="SAMTool Benchmark",
+        description="Measures the speed and mask IoU drift of inference optimizations against fp32.",
+    )
+    parser.add_argument("--imagedir", required=True)
+    parser.add_argument("--num-images", type=int, default=8)
+    parser.add_argument("--num-points", type=int, default=4)
+    parser.add_argument("--min-iou", type=float, default=0.95)
+    InferenceConfig.add_arguments(parser)
+    args = parser.parse_args()
+
+    results = benchmark(
+        args.imagedir,
+        sorted(os.listdir(args.imagedir))[: args.num_images],
+        InferenceConfig.from_args(args),
+        num_points=args.num_points,
+    )
+    print(
+        f"Mean IoU: {results['mean_iou']:.4f}, min IoU: {results['min_iou']:.4f}\n"
+        f"Encoder latency: {results['reference_latency'] * 1000:.1f} ms fp32, "
+        f"{results['candidate_latency'] * 1000:.1f} ms candidate "
+        f"({results['reference_latency'] / results['candidate_latency']:.2f}x)"
+    )
+
+    # fail so the benchmark can gate a config in scripts
+    if results["mean_iou"] < args.min_iou:
+        print(f"Mean IoU is below the threshold of {args.min_iou}.")
+        sys.exit(1)
@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import yaml
+from PIL import Image
+
+from samtool.storage import LabelStore, PNGDirStore, label_key, open_store
+
+
+def image_size(image_path: str) -> tuple[int, int]:
+    """Returns (height, width) of an image by reading only its header."""
+    with Image.open(image_path) as im:
+        width, height = im.size
+    return height, width
+
+
+def check_label(
+    store: LabelStore,
+    key: str,
+    channels: list[int],
+    num_channels: int,
+    size: None | tuple[int, int],
+    fix: bool = False,
+) -> list[dict]:
+    """Checks a single label against the annotations and its image.
+
+    Args:
+        store (LabelStore): the store holding the label
+        key (str): the key of the label
+        channels (list[int]): the channels stored for this label
+        num_channels (int): number of channels in the annotations
+        size (None | tuple[int, int]): (height, width) of the image, or None if there is no image
+        fix (bool): whether to repair the problems that can be repaired
+
+    Returns:
+        list[dict]: the problems found, each with a `key`, `kind`, `detail` and whether it was `fixed`
+    """
+    issues = []
+
+    def issue(kind: str, detail: str, fixed: bool = False):
+        issues.append({"key": key, "kind": kind, "detail": detail, "fixed": fixed})
+
+    if size is None:
+        issue("orphan", "label has no matching image")
+
+    # channels beyond the annotations are left over from an older annotations file
+    stale = [c for c in channels if c >= num_channels]
+    if stale:
+        if fix:
+            for c in stale:
+                store.delete_channel(key, c)
+        issue("stale", f"extra channels {stale}", fixed=fix)
+
+    # check the headers of the expected channels
+    for c in channels:
+        if c >= num_channels:
+            continue
+        try:
+            height, width, dtype = store.channel_info(key, c)
+        except Exception as e:
+            issue("unreadable", f"channel {c}: {e}")
+            continue
+
+        if size is not None and (height, width) != size:
+            issue("shape", f"channel {c} is {(height, width)}, image is {size}")
+        elif dtype != "bool":
+            if fix:
+                store.save_channel(key, c, store.retrieve_channel(key, c) > 0)
+            issue("dtype", f"channel {c} is {dtype}", fixed=fix)
+
+    # a partially written label is filled up with empty channels
+    missing = [c for c in range(num_channels) if c not in channels]
+    if missing:
+        fixable = fix and size is not None
+        if fixable:
+            for c in missing:
+                store.save_channel(key, c, np.zeros(size, dtype=bool))
+        issue("incomplete", f"missing channels {missing}", fixed=fixable)
+
+    return issues
+
+
+def check_labels(
+    imagedir: str,
+    labeldir: str,
+    num_channels: int,
+    fix: bool = False,
+    num_workers: int = 8,
+    state_path: None | str = None,
+) -> list[dict]:
+    """Checks every label in a store in parallel.
+
+    If a state file is given, labels whose image and label are unchanged since they
+    last passed are skipped, and the state file is updated afterwards. The state is
+    thrown away when the number of channels in the annotations changes.
+
+    Args:
+        imagedir (str): directory of the images on the disk
+        labeldir (str): directory of the labels on the disk, or a sqlite label store
+        num_channels (int): number of channels in the annotations
+        fix (bool): whether to repair the problems that can be repaired
+        num_workers (int): number of threads, the checks are mostly waiting on the disk
+        state_path (None | str): path to the state file for incremental checks
+
+    Returns:
+        list[dict]: the problems found
+    """
+    store = open_store(labeldir)
+    images = {label_key(f): f for f in os.listdir(imagedir)}
+
+    state = {}
+    if state_path is not None and os.path.isfile(state_path):
+        saved = json.load(open(state_path))
+        # labels that passed against other annotations may be missing channels or have stale ones now
+        if saved.get("num_channels") == num_channels:
+            state = saved["labels"]
+
+    def run(item: tuple[str, list[int]]) -> tuple[str, list[dict], None | list]:
+        key, channels = item
+        image_path = os.path.join(imagedir, images[key]) if key in images else None
+        stamp = None
+        if image_path is not None and store.mtime(key) is not None:
+            # the channels catch deletes, which don't change the mtime of the remaining channels
+            stamp = [os.path.getmtime(image_path), store.mtime(key), channels]
+            if state.get(key) == stamp:
+                return key, [], stamp
+
+        size = image_size(image_path) if image_path is not None else None
+        issues = check_label(store, key, channels, num_channels, size, fix=fix)
+
+        # only remember labels that are clean now
+        if any(not i["fixed"] for i in issues):
+            return key, issues, None
+        if stamp is not None and issues:
+            # every problem was fixed, so the label has exactly the annotated channels now
+            stamp = [stamp[0], store.mtime(key), list(range(num_channels))]
+        return key, issues, stamp
+
+    all_issues = []
+    new_state = {}
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for key, issues, stamp in executor.map(run, store.channel_index().items()):
+            all_issues += issues
+            if stamp is not None:
+                new_state[key] = stamp
+
+    if state_path is not None:
+        with open(state_path, "w") as f:
+            json.dump({"num_channels": num_channels, "labels": new_state}, f)
+
+    return all_issues
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="SAMTool Check",
+        description="Checks labels for missing or stale channels, shape mismatches and wrong dtypes.",
+    )
+    parser.add_argument("--imagedir", required=True)
+    parser.add_argument("--labeldir", required=True)
+    parser.add_argument("--annotations", required=True)
+    parser.add_argument("--fix", default=False, action="store_true")
+    parser.add_argument("--full", default=False, action="store_true")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    # the state lives beside the labels
+    if isinstance(open_store(args.labeldir), PNGDirStore):
+        state_path = os.path.join(args.labeldir, ".samtool-check.json")
+    else:
+        state_path = args.labeldir + ".check.json"
+    if args.full and os.path.isfile(state_path):
+        os.remove(state_path)
+
+    issues = check_labels(
+        args.imagedir,
+        args.labeldir,
+        len(yaml.safe_load(open(args.annotations))),
+        fix=args.fix,
+        num_workers=args.workers,
+        state_path=state_path,
+    )
+
+    for i in sorted(issues, key=lambda i: (i["key"], i["kind"])):
+        status = "fixed" if i["fixed"] else "found"
+        print(f"[{status}] {i['key']}: {i['kind']}, {i['detail']}")
+
+    remaining = sum(not i["fixed"] for i in issues)
+    print(f"{len(issues)} problems found, {remaining} remaining.")
+    if remaining > 0:
+        sys.exit(1)
@@ -1,262 +1,150 @@
+import threading
+
 import numpy as np
-from PIL import ImageColor
-
-colors = [
-    "#800000",
-    "#008000",
-    "#808000",
-    "#000080",
-    "#800080",
-    "#008080",
-    "#c0c0c0",
-    "#808080",
-    "#ff0000",
-    "#00ff00",
-    "#ffff00",
-    "#0000ff",
-    "#ff00ff",
-    "#00ffff",
-    "#ffffff",
-    "#000000",
-    "#00005f",
-    "#000087",
-    "#0000af",
-    "#0000d7",
-    "#0000ff",
-    "#005f00",
-    "#005f5f",
-    "#005f87",
-    "#005faf",
-    "#005fd7",
-    "#005fff",
-    "#008700",
-    "#00875f",
-    "#008787",
-    "#0087af",
-    "#0087d7",
-    "#0087ff",
-    "#00af00",
-    "#00af5f",
-    "#00af87",
-    "#00afaf",
-    "#00afd7",
-    "#00afff",
-    "#00d700",
-    "#00d75f",
-    "#00d787",
-    "#00d7af",
-    "#00d7d7",
-    "#00d7ff",
-    "#00ff00",
-    "#00ff5f",
-    "#00ff87",
-    "#00ffaf",
-    "#00ffd7",
-    "#00ffff",
-    "#5f0000",
-    "#5f005f",
-    "#5f0087",
-    "#5f00af",
-    "#5f00d7",
-    "#5f00ff",
-    "#5f5f00",
-    "#5f5f5f",
-    "#5f5f87",
-    "#5f5faf",
-    "#5f5fd7",
-    "#5f5fff",
-    "#5f8700",
-    "#5f875f",
-    "#5f8787",
-    "#5f87af",
-    "#5f87d7",
-    "#5f87ff",
-    "#5faf00",
-    "#5faf5f",
-    "#5faf87",
-    "#5fafaf",
-    "#5fafd7",
-    "#5fafff",
-    "#5fd700",
-    "#5fd75f",
-    "#5fd787",
-    "#5fd7af",
-    "#5fd7d7",
-    "#5fd7ff",
-    "#5fff00",
-    "#5fff5f",
-    "#5fff87",
-    "#5fffaf",
-    "#5fffd7",
-    "#5fffff",
-    "#870000",
-    "#87005f",
-    "#870087",
-    "#8700af",
-    "#8700d7",
-    "#8700ff",
-    "#875f00",
-    "#875f5f",
-    "#875f87",
-    "#875faf",
-    "#875fd7",
-    "#875fff",
-    "#878700",
-    "#87875f",
-    "#878787",
-    "#8787af",
-    "#8787d7",
-    "#8787ff",
-    "#87af00",
-    "#87af5f",
-    "#87af87",
-    "#87afaf",
-    "#87afd7",
-    "#87afff",
-    "#87d700",
-    "#87d75f",
-    "#87d787",
-    "#87d7af",
-    "#87d7d7",
-    "#87d7ff",
-    "#87ff00",
-    "#87ff5f",
-    "#87ff87",
-    "#87ffaf",
-    "#87ffd7",
-    "#87ffff",
-    "#af0000",
-    "#af005f",
-    "#af0087",
-    "#af00af",
-    "#af00d7",
-    "#af00ff",
-    "#af5f00",
-    "#af5f5f",
-    "#af5f87",
-    "#af5faf",
-    "#af5fd7",
-    "#af5fff",
-    "#af8700",
-    "#af875f",
-    "#af8787",
-    "#af87af",
-    "#af87d7",
-    "#af87ff",
-    "#afaf00",
-    "#afaf5f",
-    "#afaf87",
-    "#afafaf",
-    "#afafd7",
-    "#afafff",
-    "#afd700",
-    "#afd75f",
-    "#afd787",
-    "#afd7af",
-    "#afd7d7",
-    "#afd7ff",
-    "#afff00",
-    "#afff5f",
-    "#afff87",
-    "#afffaf",
-    "#afffd7",
-    "#afffff",
-    "#d70000",
-    "#d7005f",
-    "#d70087",
-    "#d700af",
-    "#d700d7",
-    "#d700ff",
-    "#d75f00",
-    "#d75f5f",
-    "#d75f87",
-    "#d75faf",
-    "#d75fd7",
-    "#d75fff",
-    "#d78700",
-    "#d7875f",
-    "#d78787",
-    "#d787af",
-    "#d787d7",
-    "#d787ff",
-    "#d7af00",
-    "#d7af5f",
-    "#d7af87",
-    "#d7afaf",
-    "#d7afd7",
-    "#d7afff",
-    "#d7d700",
-    "#d7d75f",
-    "#d7d787",
-    "#d7d7af",
-    "#d7d7d7",
-    "#d7d7ff",
-    "#d7ff00",
-    "#d7ff5f",
-    "#d7ff87",
-    "#d7ffaf",
-    "#d7ffd7",
-    "#d7ffff",
-    "#ff0000",
-    "#ff005f",
-    "#ff0087",
-    "#ff00af",
-    "#ff00d7",
-    "#ff00ff",
-    "#ff5f00",
-    "#ff5f5f",
-    "#ff5f87",
-    "#ff5faf",
-    "#ff5fd7",
-    "#ff5fff",
-    "#ff8700",
-    "#ff875f",
-    "#ff8787",
-    "#ff87af",
-    "#ff87d7",
-    "#ff87ff",
-    "#ffaf00",
-    "#ffaf5f",
-    "#ffaf87",
-    "#ffafaf",
-    "#ffafd7",
-    "#ffafff",
-    "#ffd700",
-    "#ffd75f",
-    "#ffd787",
-    "#ffd7af",
-    "#ffd7d7",
-    "#ffd7ff",
-    "#ffff00",
-    "#ffff5f",
-    "#ffff87",
-    "#ffffaf",
-    "#ffffd7",
-    "#ffffff",
-    "#080808",
-    "#121212",
-    "#1c1c1c",
-    "#262626",
-    "#303030",
-    "#3a3a3a",
-    "#444444",
-    "#4e4e4e",
-    "#585858",
-    "#606060",
-    "#666666",
-    "#767676",
-    "#808080",
-    "#8a8a8a",
-    "#949494",
-    "#9e9e9e",
-    "#a8a8a8",
-    "#b2b2b2",
-    "#bcbcbc",
-    "#c6c6c6",
-    "#d0d0d0",
-    "#dadada",
-    "#e4e4e4",
-    "#eeeeee",
-]
-
-colors = np.array([ImageColor.getcolor(c, "RGB") for c in colors])
+
+# the golden ratio spreads consecutive hues as far apart as possible for any number of colors
+_GOLDEN_RATIO = 0.618033988749895
+
+# bounds of lightness and chroma in oklch, dark or greyish colors are hard to tell apart in an overlay
+_LIGHTNESS = (0.45, 0.85)
+_CHROMA = (0.06, 0.2)
+
+_lock = threading.Lock()
+_colors = np.zeros((0, 3), dtype=np.uint8)
+_halves = np.zeros((0, 3), dtype=np.uint8)
+
+
+def _halton(index: np.ndarray, base: int) -> np.ndarray:
+    """The radical inverse of index in base, a low-discrepancy sequence in [0, 1)."""
+    index = index.copy()
+    result = np.zeros(index.shape)
+    fraction = 1.0 / base
+    while index.any():
+        result += fraction * (index % base)
+        index //= base
+        fraction /= base
+    return result
+
+
+def _oklab_to_linear_srgb(lab: np.ndarray) -> np.ndarray:
+    lms = lab @ np.array(
+        [
+            [1.0, 1.0, 1.0],
+            [0.3963377774, -0.1055613458, -0.0894841775],
+            [0.2158037573, -0.0638541728, -1.2914855480],
+        ]
+    )
+    return (lms**3) @ np.array(
+        [
+            [4.0767416621, -1.2684380046, -0.0041960863],
+            [-3.3077115913, 2.6097574011, -0.7034186147],
+            [0.2309699292, -0.3413193965, 1.7076147010],
+        ]
+    )
+
+
+def _linear_srgb_to_oklab(rgb: np.ndarray) -> np.ndarray:
+    lms = rgb @ np.array(
+        [
+            [0.4122214708, 0.2119034982, 0.0883024619],
+            [0.5363325363, 0.6806995451, 0.2817188376],
+            [0.0514459929, 0.1073969566, 0.6299787005],
+        ]
+    )
+    return np.cbrt(lms) @ np.array(
+        [
+            [0.2104542553, 1.9779984951, 0.0259040371],
+            [0.7936177850, -2.4285922050, 0.7827717662],
+            [-0.0040720468, 0.4505937099, -0.8086757660],
+        ]
+    )
+
+
+def _to_srgb(linear: np.ndarray) -> np.ndarray:
+    linear = np.clip(linear, 0.0, 1.0)
+    return np.where(
+        linear <= 0.0031308, 12.92 * linear, 1.055 * linear ** (1 / 2.4) - 0.055
+    )
+
+
+def _to_linear(srgb: np.ndarray) -> np.ndarray:
+    return np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+
+
+def _candidates(num_candidates: int) -> tuple[np.ndarray, np.ndarray]:
+    """The stream of candidate colors, in uint8 RGB and in the oklab coordinates of that RGB."""
+    i = np.arange(num_candidates)
+    hue = 2.0 * np.pi * ((i * _GOLDEN_RATIO) % 1.0)
+    lightness = _LIGHTNESS[0] + (_LIGHTNESS[1] - _LIGHTNESS[0]) * _halton(i + 1, 2)
+    chroma = _CHROMA[0] + (_CHROMA[1] - _CHROMA[0]) * _halton(i + 1, 3)
+
+    # pull chroma in until the color fits in srgb, keeping its hue and lightness
+    for _ in range(32):
+        lab = np.stack([lightness, chroma * np.cos(hue), chroma * np.sin(hue)], axis=-1)
+        linear = _oklab_to_linear_srgb(lab)
+        outside = ((linear < 0.0) | (linear > 1.0)).any(axis=-1)
+        if not outside.any():
+            break
+        chroma = np.where(outside, chroma * 0.9, chroma)
+
+    rgb = np.round(_to_srgb(linear) * 255.0).astype(np.uint8)
+    return rgb, _linear_srgb_to_oklab(_to_linear(rgb / 255.0))
+
+
+def generate_colors(num_colors: int, attempts: int = 16) -> np.ndarray:
+    """Generates a palette of perceptually distinct colors.
+
+    Candidates step hue by the golden ratio and take lightness and chroma from a Halton sequence in oklch.
+    Each color is the one of the next attempts candidates farthest in oklab from the colors already picked,
+    so a near-duplicate is only picked when every candidate is one, and an exact duplicate practically never.
+    The first N colors are the same whatever num_colors is, so the palette can grow.
+
+    Args:
+        num_colors (int): number of colors
+        attempts (int): number of candidates tried for each color
+
+    Returns:
+        np.ndarray: an array of [N, 3] uint8 RGB colors
+    """
+    rgb, lab = _candidates(num_colors * attempts)
+    picked = np.zeros((num_colors,), dtype=int)
+    squares = (lab**2).sum(axis=-1)
+
+    for n in range(1, num_colors):
+        window = slice(n * attempts, (n + 1) * attempts)
+        chosen = picked[:n]
+
+        # squared distances as |a|^2 + |b|^2 - 2ab, a matrix product instead of an [attempts, n, 3] array
+        distances = (
+            squares[window, None]
+            + squares[None, chosen]
+            - 2.0 * lab[window] @ lab[chosen].T
+        )
+        picked[n] = window.start + np.argmax(distances.min(axis=1))
+
+    return rgb[picked]
+
+
+def palette(num_colors: int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns a color lookup table with at least num_colors entries.
+
+    The table is generated once and only regenerated when more colors are asked for.
+    Alongside the colors, their halves are precomputed so a 50% blend is just
+    `(image >> 1) + halves[index]` in uint8 with no float conversion.
+
+    Args:
+        num_colors (int): minimum number of colors
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: [N, 3] uint8 colors and [N, 3] uint8 halves of the colors
+    """
+    global _colors, _halves
+    with _lock:
+        if len(_colors) < num_colors:
+            # grow geometrically so repeated small increases are cheap
+            _colors = generate_colors(max(num_colors, 2 * len(_colors), 256))
+            _halves = _colors >> 1
+        return _colors, _halves
+
+
+colors, _ = palette(256)
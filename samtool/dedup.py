@@ -0,0 +1,198 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+# number of set bits for every possible byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def image_hash(image_path: str, hash_size: int = 8) -> np.ndarray:
+    """Computes the difference hash (dHash) of an image.
+
+    Args:
+        image_path (str): path to the image on the disk
+        hash_size (int): side length of the hash grid, the hash has hash_size**2 bits
+
+    Returns:
+        np.ndarray: the hash as a packed array of uint8 of length hash_size**2 / 8
+    """
+    # the reduced decode skips most of the jpeg work, we only need a thumbnail
+    image = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        raise ValueError(f"Unable to read image {image_path}.")
+
+    image = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return np.packbits(image[:, 1:] > image[:, :-1])
+
+
+def compute_hashes(
+    images_path: str, filenames: list[str], num_workers: int = 8
+) -> np.ndarray:
+    """Computes the hashes for a batch of images in parallel.
+
+    Args:
+        images_path (str): directory of the images on the disk
+        filenames (list[str]): names of the images to hash
+        num_workers (int): number of threads, cv2 releases the GIL while decoding
+
+    Returns:
+        np.ndarray: an array of [N, B] packed hashes
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        hashes = list(
+            executor.map(lambda f: image_hash(os.path.join(images_path, f)), filenames)
+        )
+    return np.stack(hashes, axis=0)
+
+
+def hamming_distance(hashes: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Hamming distance between a set of packed hashes and one or more queries.
+
+    Args:
+        hashes (np.ndarray): an array of [N, B] packed hashes
+        query (np.ndarray): an array of [B] or [M, B] packed hashes
+
+    Returns:
+        np.ndarray: an array of [N] or [M, N] distances
+    """
+    if query.ndim == 1:
+        return _POPCOUNT[hashes ^ query].sum(axis=-1, dtype=np.int32)
+    return _POPCOUNT[query[:, None, :] ^ hashes[None, :, :]].sum(
+        axis=-1, dtype=np.int32
+    )
+
+
+class DuplicateIndex:
+    """DuplicateIndex.
+
+    Nearest neighbour index over perceptual hashes for finding near-duplicate images.
+    """
+
+    def __init__(self, filenames: list[str], hashes: np.ndarray, threshold: int = 4):
+        """__init__.
+
+        Args:
+            filenames (list[str]): names of the images, in the same order as hashes
+            hashes (np.ndarray): an array of [N, B] packed hashes
+            threshold (int): maximum hamming distance for two images to be considered duplicates
+        """
+        assert len(filenames) == len(hashes)
+        self.filenames = list(filenames)
+        self.hashes = hashes
+        self.threshold = threshold
+        self._lookup = {f: i for i, f in enumerate(self.filenames)}
+        self._representatives = self._group()
+
+    @classmethod
+    def build(
+        cls,
+        images_path: str,
+        filenames: None | list[str] = None,
+        threshold: int = 4,
+        num_workers: int = 8,
+    ) -> "DuplicateIndex":
+        """Hashes every image in a directory and builds the index."""
+        if filenames is None:
+            filenames = sorted(os.listdir(images_path))
+        hashes = compute_hashes(images_path, filenames, num_workers=num_workers)
+        return cls(filenames, hashes, threshold=threshold)
+
+    @classmethod
+    def load(cls, index_path: str, threshold: None | int = None) -> "DuplicateIndex":
+        """Loads an index previously written with `save`."""
+        data = np.load(index_path)
+        return cls(
+            filenames=data["filenames"].tolist(),
+            hashes=data["hashes"],
+            threshold=int(data["threshold"]) if threshold is None else threshold,
+        )
+
+    def save(self, index_path: str) -> None:
+        """Saves the index to an npz file."""
+        np.savez(
+            index_path,
+            filenames=np.array(self.filenames),
+            hashes=self.hashes,
+            threshold=self.threshold,
+        )
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self._lookup
+
+    def _group(self, chunk_size: int = 1024) -> np.ndarray:
+        """Groups near-duplicates around leaders, returns the representative of each image.
+
+        In order, each image that isn't in a group yet leads a new group of all later images within
+        the threshold of it. Unlike a transitive grouping, a slow pan doesn't collapse into one group,
+        every image is within the threshold of its representative.
+        The distances are computed in chunks so memory stays at chunk_size * N.
+        """
+        representatives = np.full(len(self.filenames), -1, dtype=np.int64)
+
+        for start in range(0, len(self.hashes), chunk_size):
+            distances = hamming_distance(
+                self.hashes, self.hashes[start : start + chunk_size]
+            )
+            for row, leader in enumerate(range(start, start + len(distances))):
+                if representatives[leader] >= 0:
+                    continue
+                # earlier images are all grouped already, so only later ones can join
+                members = (distances[row] <= self.threshold) & (representatives < 0)
+                representatives[members] = leader
+
+        return representatives
+
+    def representative(self, filename: str) -> str:
+        """Returns the image that stands in for the group this image belongs to."""
+        return self.filenames[self._representatives[self._lookup[filename]]]
+
+    def is_redundant(self, filename: str) -> bool:
+        """Whether the image is a near-duplicate of an earlier image that leads its group."""
+        if filename not in self._lookup:
+            return False
+        return self.representative(filename) != filename
+
+    def groups(self) -> list[list[str]]:
+        """Returns all groups of near-duplicates with more than one member."""
+        groups: dict[int, list[str]] = {}
+        for filename, rep in zip(self.filenames, self._representatives):
+            groups.setdefault(int(rep), []).append(filename)
+        return [g for g in groups.values() if len(g) > 1]
+
+    def neighbours(self, filename: str) -> list[str]:
+        """Returns the near-duplicates of an image, nearest first."""
+        index = self._lookup[filename]
+        distances = hamming_distance(self.hashes, self.hashes[index])
+        order = np.argsort(distances, kind="stable")
+        return [
+            self.filenames[i]
+            for i in order
+            if i != index and distances[i] <= self.threshold
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="SAMTool Dedup",
+        description="Builds a near-duplicate index over an image directory for SAMTool.",
+    )
+    parser.add_argument("--imagedir", required=True)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--threshold", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    index = DuplicateIndex.build(
+        args.imagedir, threshold=args.threshold, num_workers=args.workers
+    )
+    index.save(args.output)
+
+    groups = index.groups()
+    redundant = sum(len(g) - 1 for g in groups)
+    print(
+        f"Indexed {len(index.filenames)} images, "
+        f"found {len(groups)} groups of near-duplicates covering {redundant} redundant images."
+    )
@@ -0,0 +1,116 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+from segment_anything import SamPredictor
+
+from samtool.inference import InferenceConfig
+from samtool.memory import LRUCache, MemoryBudget
+
+
+def embedding_key(image_path: str) -> str:
+    """Cache key for an image on the disk, changes whenever the image file changes."""
+    stat = os.stat(image_path)
+    identity = f"{os.path.abspath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+
+def capture_embeddings(predictor: SamPredictor) -> dict:
+    """The embeddings currently set on the predictor, as an entry `restore_embeddings` accepts."""
+    return {
+        "features": predictor.features,
+        "original_size": predictor.original_size,
+        "input_size": predictor.input_size,
+    }
+
+
+def restore_embeddings(predictor: SamPredictor, entry: dict) -> None:
+    """Sets embeddings from `capture_embeddings` back on the predictor, without running the encoder."""
+    predictor.reset_image()
+    predictor.features = entry["features"]
+    predictor.original_size = entry["original_size"]
+    predictor.input_size = entry["input_size"]
+    predictor.is_image_set = True
+
+
+class EmbeddingCache:
+    """EmbeddingCache.
+
+    Keeps SAM image embeddings so revisiting an image skips the image encoder.
+    Recent embeddings are held in memory, and all embeddings are written to a
+    directory on the disk if one is given.
+    """
+
+    def __init__(
+        self,
+        cache_dir: None | str = None,
+        max_entries: int = 8,
+        budget: None | MemoryBudget = None,
+    ):
+        """__init__.
+
+        Args:
+            cache_dir (None | str): directory to keep embeddings in, or None for memory only
+            max_entries (int): number of embeddings held in memory
+            budget (None | MemoryBudget): memory budget the embeddings held in memory count against
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._entries = LRUCache("embeddings", budget=budget, max_entries=max_entries)
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def load(self, key: str, predictor: SamPredictor) -> bool:
+        """Restores the embeddings for a key onto the predictor.
+
+        Returns:
+            bool: whether the embeddings were found
+        """
+        entry = self._entries.get(key)
+
+        if entry is None and self.cache_dir is not None:
+            if not os.path.isfile(self._path(key)):
+                return False
+            entry = torch.load(self._path(key), map_location=predictor.device)
+            self._entries.put(key, entry)
+
+        if entry is None:
+            return False
+
+        restore_embeddings(predictor, entry)
+        return True
+
+    def save(self, key: str, predictor: SamPredictor) -> None:
+        """Stores the embeddings currently set on the predictor under a key."""
+        entry = capture_embeddings(predictor)
+        self._entries.put(key, entry)
+
+        if self.cache_dir is not None:
+            torch.save({**entry, "features": entry["features"].cpu()}, self._path(key))
+
+    def set_image(
+        self,
+        inference: InferenceConfig,
+        predictor: SamPredictor,
+        image: np.ndarray,
+        key: None | str,
+    ) -> None:
+        """Sets an image on the predictor, only running the image encoder on a cache miss.
+
+        Args:
+            inference (InferenceConfig): the config to run the encoder with
+            predictor (SamPredictor): the predictor to set the image on
+            image (np.ndarray): the RGB image
+            key (None | str): the cache key, or None to skip the cache
+        """
+        if key is not None and self.load(key, predictor):
+            return
+
+        inference.set_image(predictor, image)
+        if key is not None:
+            self.save(key, predictor)
@@ -0,0 +1,190 @@
+import argparse
+import json
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+import numpy as np
+import yaml
+from PIL import Image
+
+from samtool.storage import open_store
+
+
+def to_index_map(label: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Converts a multi-hot label into a single channel class index map.
+
+    Channel 0 is `__ignore__`, so pixels marked with it, or with no label at all, map to 0.
+    Pixels marked with more than one class are conflicts and also map to 0.
+
+    Args:
+        label (np.ndarray): an array of [H, W, C] booleans
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: the [H, W] index map, uint8 if C <= 256 else uint16,
+            and the [H, W] boolean map of conflicting pixels
+    """
+    num_channels = label.shape[-1]
+    dtype = np.uint8 if num_channels <= 256 else np.uint16
+
+    # one channel at a time, so memory stays at a couple of [H, W] arrays
+    index = np.zeros(label.shape[:2], dtype=dtype)
+    conflicts = np.zeros(label.shape[:2], dtype=bool)
+    for c in range(1, num_channels):
+        mask = label[..., c]
+        conflicts |= mask & (index != 0)
+        index[mask] = c
+
+    index[conflicts] = 0
+    index[label[..., 0]] = 0
+    return index, conflicts
+
+
+def label_stats(label: np.ndarray, index: np.ndarray, conflicts: np.ndarray) -> dict:
+    """Per class statistics of a single label.
+
+    Args:
+        label (np.ndarray): an array of [H, W, C] booleans
+        index (np.ndarray): the [H, W] index map from `to_index_map`
+        conflicts (np.ndarray): the [H, W] conflict map from `to_index_map`
+
+    Returns:
+        dict: pixel counts per class in the index map, connected component counts per channel,
+            and the number of conflicting pixels
+    """
+    pixels = np.bincount(index.ravel(), minlength=label.shape[-1])
+    instances = [
+        cv2.connectedComponents(label[..., c].astype(np.uint8), connectivity=8)[0] - 1
+        for c in range(label.shape[-1])
+    ]
+    return {
+        "pixels": pixels.tolist(),
+        "instances": instances,
+        "conflicts": int(conflicts.sum()),
+    }
+
+
+def _export_one(labeldir: str, key: str, outdir: None | str) -> tuple[str, dict]:
+    """Converts and measures a single label, runs inside a worker process."""
+    label = open_store(labeldir).retrieve(key)
+    index, conflicts = to_index_map(label)
+    if outdir is not None:
+        Image.fromarray(index).save(os.path.join(outdir, key + ".png"))
+    return key, label_stats(label, index, conflicts)
+
+
+def export_labels(
+    labeldir: str,
+    class_names: list[str],
+    outdir: None | str = None,
+    num_workers: None | int = None,
+    memory_budget: int = 2 << 30,
+) -> dict:
+    """Converts every label in a store to index maps and aggregates per class statistics.
+
+    Labels are spread over a process pool. Each worker reads, converts and writes its own labels
+    and only sends statistics back, and the number of labels in flight is capped so the
+    workers together stay within the memory budget.
+
+    Args:
+        labeldir (str): directory of the labels on the disk, or a sqlite label store
+        class_names (list[str]): names of the classes, ordered by channel
+        outdir (None | str): directory to write the index maps to, or None for statistics only
+        num_workers (None | int): number of processes, defaults to the number of cores
+        memory_budget (int): approximate number of bytes the labels in flight may use
+
+    Returns:
+        dict: the aggregated report
+    """
+    store = open_store(labeldir)
+    keys = list(store.keys())
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+
+    report = {
+        "classes": class_names,
+        "images": 0,
+        "pixels": [0] * len(class_names),
+        "instances": [0] * len(class_names),
+        "images_per_class": [0] * len(class_names),
+        "conflict_pixels": 0,
+        "conflict_images": [],
+    }
+    if len(keys) == 0:
+        return report
+
+    # a label costs itself plus a few [H, W] working arrays
+    height, width, channels = store.retrieve(keys[0]).shape
+    per_label = height * width * (channels + 8)
+    num_workers = num_workers or os.cpu_count() or 1
+    max_in_flight = max(1, min(memory_budget // per_label, num_workers * 2))
+
+    def collect(key: str, stats: dict):
+        report["images"] += 1
+        for c in range(len(class_names)):
+            report["pixels"][c] += stats["pixels"][c]
+            report["instances"][c] += stats["instances"][c]
+            report["images_per_class"][c] += stats["instances"][c] > 0
+        report["conflict_pixels"] += stats["conflicts"]
+        if stats["conflicts"] > 0:
+            report["conflict_images"].append(key)
+
+    # spawned workers open their own store, a forked sqlite connection is not safe to use
+    with ProcessPoolExecutor(
+        max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        in_flight = set()
+        for key in keys:
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(*future.result())
+            in_flight.add(executor.submit(_export_one, labeldir, key, outdir))
+
+        for future in wait(in_flight).done:
+            collect(*future.result())
+
+    report["conflict_images"].sort()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="SAMTool Export",
+        description="Exports labels as class index maps and reports per class statistics.",
+    )
+    parser.add_argument("--labeldir", required=True)
+    parser.add_argument("--annotations", required=True)
+    parser.add_argument("--outdir", default=None)
+    parser.add_argument("--report", default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--memory-budget-mb", type=int, default=2048)
+    args = parser.parse_args()
+
+    annotations = yaml.safe_load(open(args.annotations))
+    class_names = sorted(annotations, key=annotations.get)
+
+    report = export_labels(
+        args.labeldir,
+        class_names,
+        outdir=args.outdir,
+        num_workers=args.workers,
+        memory_budget=args.memory_budget_mb << 20,
+    )
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+    print(f"Exported {report['images']} labels.")
+    for c, name in enumerate(class_names):
+        print(
+            f"{name}: {report['pixels'][c]} pixels, "
+            f"{report['instances'][c]} instances in {report['images_per_class'][c]} images"
+        )
+    if report["conflict_pixels"] > 0:
+        print(
+            f"{report['conflict_pixels']} pixels in {len(report['conflict_images'])} images "
+            "have more than one class and were set to 0."
+        )
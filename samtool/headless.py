@@ -0,0 +1,371 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+import yaml
+from segment_anything import SamPredictor
+
+from samtool.embeddings import (
+    EmbeddingCache,
+    capture_embeddings,
+    embedding_key,
+    restore_embeddings,
+)
+from samtool.inference import InferenceConfig
+from samtool.storage import LabelStore, label_key, open_store
+from samtool.weights import add_arguments as add_checkpoint_arguments
+
+_predictors: dict[tuple, SamPredictor] = {}
+_predictors_lock = threading.Lock()
+_embedding_cache: None | EmbeddingCache = None
+
+
+def shared_predictor(
+    inference: None | InferenceConfig = None,
+    checkpoint: None | str = None,
+    cache_dir: None | str = None,
+) -> tuple[InferenceConfig, SamPredictor]:
+    """Returns a predictor that is loaded once per process and shared by all sessions.
+
+    Args:
+        inference (None | InferenceConfig): torch optimizations, defaults to plain fp32
+        checkpoint (None | str): path to the weights, downloaded into the cache if not given
+        cache_dir (None | str): directory to download the weights to
+
+    Returns:
+        tuple[InferenceConfig, SamPredictor]:
+    """
+    from samtool.sammer import load_predictor
+
+    inference = inference or InferenceConfig()
+    key = (tuple(sorted(vars(inference).items())), checkpoint, cache_dir)
+    with _predictors_lock:
+        if key not in _predictors:
+            _predictors[key] = load_predictor(
+                inference, checkpoint=checkpoint, cache_dir=cache_dir
+            )
+        return inference, _predictors[key]
+
+
+def shared_embedding_cache() -> EmbeddingCache:
+    """Returns an in memory embedding cache that is shared by all sessions in this process."""
+    global _embedding_cache
+    with _predictors_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache()
+        return _embedding_cache
+
+
+class Session:
+    """Session.
+
+    Headless annotation of a single image, without any of the ui state of `Sammer`.
+    Sessions share one predictor per process. Each session keeps its own embeddings and puts them
+    back on the predictor before predicting, so sessions can be interleaved, but only one session
+    should predict at a time in a given process.
+    """
+
+    def __init__(
+        self,
+        image: str | np.ndarray,
+        labels: None | dict[str, int] = None,
+        store: None | LabelStore = None,
+        inference: None | InferenceConfig = None,
+        checkpoint: None | str = None,
+        cache_dir: None | str = None,
+        embedding_cache: None | EmbeddingCache = None,
+    ):
+        """__init__.
+
+        Args:
+            image (str | np.ndarray): path to an image, or an RGB image array
+            labels (None | dict[str, int]): mapping of label names to channel indices, needed to commit
+            store (None | LabelStore): where committed labels are saved, needs `image` to be a path
+            inference (None | InferenceConfig): torch optimizations, defaults to plain fp32
+            checkpoint (None | str): path to the weights, downloaded into the cache if not given
+            cache_dir (None | str): directory to download the weights to
+            embedding_cache (None | EmbeddingCache): cache to reuse embeddings from, needs `image` to be a path,
+                defaults to an in memory cache shared by all sessions in this process
+        """
+        self.labels = labels
+        self.store = store
+        self.inference, self.predictor = shared_predictor(
+            inference, checkpoint=checkpoint, cache_dir=cache_dir
+        )
+
+        # load the image, only images from the disk have a cache key
+        embedding_cache = embedding_cache or shared_embedding_cache()
+        if isinstance(image, str):
+            self.filename = os.path.basename(image)
+            key = embedding_key(image)
+            image = cv2.cvtColor(cv2.imread(image), cv2.COLOR_BGR2RGB)
+        else:
+            self.filename = None
+            key = None
+        self.image = image
+
+        # compute the embeddings, reusing cached ones if possible
+        embedding_cache.set_image(self.inference, self.predictor, image, key)
+        self._embeddings = capture_embeddings(self.predictor)
+
+        # the label starts from whatever is already stored
+        self.label: None | np.ndarray = None
+        self._stored = False
+        if (
+            self.store is not None
+            and self.filename is not None
+            and self.labels is not None
+            and self.store.exists(label_key(self.filename), len(self.labels))
+        ):
+            self.label = self.store.retrieve(label_key(self.filename))
+            self._stored = True
+
+        self.masks = np.zeros((0, *image.shape[:2]), dtype=bool)
+
+    def predict(
+        self,
+        points: None | np.ndarray = None,
+        point_labels: None | np.ndarray = None,
+        boxes: None | np.ndarray = None,
+        batch: bool = True,
+    ) -> np.ndarray:
+        """Predicts masks from prompts on the embeddings of this image.
+
+        In batch mode every prompt gives its own mask: points are (B, N, 2), point labels
+        are (B, N) and boxes are (B, 4). Points with a label of -1 are padding, so prompts
+        with different numbers of points can share a batch.
+        Otherwise all prompts together give a single mask: points are (N, 2), point labels
+        are (N,) and boxes are (4,).
+        Point labels default to all positive.
+
+        Returns:
+            np.ndarray: (B, H, W) array of booleans, also kept as `masks` for `commit`
+        """
+        if points is not None and point_labels is None:
+            point_labels = np.ones(points.shape[:-1], dtype=int)
+
+        # another session may have set its own image on the shared predictor since
+        if self.predictor.features is not self._embeddings["features"]:
+            restore_embeddings(self.predictor, self._embeddings)
+
+        if not batch:
+            with self.inference.context():
+                masks, _, _ = self.predictor.predict(
+                    point_coords=points,
+                    point_labels=point_labels,
+                    box=boxes,
+                    multimask_output=False,
+                )
+            self.masks = masks[:1]
+            return self.masks
+
+        image_size = self.image.shape[:2]
+        device = self.predictor.device
+        t_points, t_labels, t_boxes = None, None, None
+        if points is not None:
+            t_points = self.predictor.transform.apply_coords_torch(
+                torch.as_tensor(points, dtype=torch.float, device=device), image_size
+            )
+            t_labels = torch.as_tensor(point_labels, dtype=torch.int, device=device)
+        if boxes is not None:
+            t_boxes = self.predictor.transform.apply_boxes_torch(
+                torch.as_tensor(boxes, dtype=torch.float, device=device), image_size
+            )
+
+        with self.inference.context():
+            masks, _, _ = self.predictor.predict_torch(
+                point_coords=t_points,
+                point_labels=t_labels,
+                boxes=t_boxes,
+                multimask_output=False,
+            )
+        self.masks = masks[:, 0].cpu().numpy()
+        return self.masks
+
+    def commit(self, label: str, add: bool = True, save: bool = True) -> np.ndarray:
+        """Merges the masks of the last prediction into a channel of the label.
+
+        Args:
+            label (str): name of the label to merge into
+            add (bool): whether to add the masks or remove them
+            save (bool): whether to save the label to the store
+
+        Returns:
+            np.ndarray: the label as an array of [H, W, C]
+        """
+        assert self.labels is not None and label in self.labels
+
+        if self.label is None:
+            self.label = np.zeros((*self.image.shape[:2], len(self.labels)), dtype=bool)
+
+        channel = self.labels[label]
+        merged = self.masks.any(axis=0)
+        if add:
+            self.label[..., channel] |= merged
+        else:
+            self.label[..., channel] &= np.logical_not(merged)
+
+        if save:
+            self.save(channel)
+
+        self.masks = np.zeros((0, *self.image.shape[:2]), dtype=bool)
+        return self.label
+
+    def save(self, channel: None | int = None) -> None:
+        """Saves the label to the store.
+
+        Args:
+            channel (None | int): only save this channel, if the label is already in the store
+        """
+        if self.store is None or self.filename is None or self.label is None:
+            return
+
+        # a label that isn't in the store yet has to be written in full
+        if channel is None or not self._stored:
+            self.store.save(label_key(self.filename), self.label)
+            self._stored = True
+        else:
+            self.store.save_channel(
+                label_key(self.filename), channel, self.label[..., channel]
+            )
+
+
+def load_prompts(prompts_path: str) -> dict[str, list[dict]]:
+    """Loads a prompts file, grouped by image.
+
+    A json file maps image filenames to lists of prompts, where each prompt has a `label`
+    and any of `points` as [[x, y], ...], `point_labels` as [1, 0, ...] and `box` as [x0, y0, x1, y1].
+
+    A csv file has one prompt per row with the columns `image`, `label`, and either
+    `x`, `y` and optionally `positive` for a point, or `x0`, `y0`, `x1`, `y1` for a box.
+
+    Args:
+        prompts_path (str): path to a json or csv prompts file
+
+    Returns:
+        dict[str, list[dict]]: prompts per image filename
+    """
+    if prompts_path.endswith(".json"):
+        return json.load(open(prompts_path))
+
+    prompts: dict[str, list[dict]] = {}
+    with open(prompts_path, newline="") as f:
+        for row in csv.DictReader(f):
+            prompt: dict = {"label": row["label"]}
+            if row.get("x0"):
+                prompt["box"] = [float(row[k]) for k in ("x0", "y0", "x1", "y1")]
+            else:
+                prompt["points"] = [[float(row["x"]), float(row["y"])]]
+                prompt["point_labels"] = [int(row.get("positive") or 1)]
+            prompts.setdefault(row["image"], []).append(prompt)
+    return prompts
+
+
+def apply_prompts(session: Session, prompts: list[dict]) -> None:
+    """Runs a list of prompts on a session in batches and commits each result to its label.
+
+    Prompts with and without boxes are batched separately,
+    and points are padded with -1 labels so each batch has a common number of points.
+    """
+    for with_box in (True, False):
+        group = [p for p in prompts if ("box" in p) == with_box]
+        if len(group) == 0:
+            continue
+
+        num_points = max(len(p.get("points", [])) for p in group)
+        points, point_labels = None, None
+        if num_points > 0:
+            points = np.zeros((len(group), num_points, 2), dtype=np.float32)
+            point_labels = -np.ones((len(group), num_points), dtype=int)
+            for i, p in enumerate(group):
+                n = len(p.get("points", []))
+                if n == 0:
+                    continue
+                points[i, :n] = p["points"]
+                point_labels[i, :n] = p.get("point_labels", [1] * n)
+        boxes = (
+            np.array([p["box"] for p in group], dtype=np.float32) if with_box else None
+        )
+
+        masks = session.predict(points=points, point_labels=point_labels, boxes=boxes)
+        for label in {p["label"] for p in group}:
+            session.masks = masks[[p["label"] == label for p in group]]
+            session.commit(label, save=False)
+
+    session.save()
+
+
+_worker_config: dict = {}
+
+
+def _init_worker(config: dict) -> None:
+    """Keeps the job configuration in each worker process."""
+    _worker_config.update(config)
+    _worker_config["inference"].apply_threads()
+    if config["embedding_cache"] is not None:
+        _worker_config["embedding_cache"] = EmbeddingCache(config["embedding_cache"])
+
+
+def _apply_one(filename: str, prompts: list[dict]) -> str:
+    """Applies the prompts for one image, runs inside a worker process."""
+    config = _worker_config
+    session = Session(
+        os.path.join(config["imagedir"], filename),
+        labels=config["labels"],
+        store=open_store(config["labeldir"]),
+        inference=config["inference"],
+        checkpoint=config["checkpoint"],
+        cache_dir=config["cache_dir"],
+        embedding_cache=config["embedding_cache"],
+    )
+    apply_prompts(session, prompts)
+    return filename
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="SAMTool Apply",
+        description="Applies a file of point and box prompts to many images without the ui.",
+    )
+    parser.add_argument("--imagedir", required=True)
+    parser.add_argument("--labeldir", required=True)
+    parser.add_argument("--annotations", required=True)
+    parser.add_argument("--prompts", required=True)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--embedding-cache", default=None)
+    InferenceConfig.add_arguments(parser)
+    add_checkpoint_arguments(parser)
+    args = parser.parse_args()
+
+    config = {
+        "imagedir": args.imagedir,
+        "labeldir": args.labeldir,
+        "labels": yaml.safe_load(open(args.annotations)),
+        "inference": InferenceConfig.from_args(args),
+        "checkpoint": args.checkpoint,
+        "cache_dir": args.cache_dir,
+        "embedding_cache": args.embedding_cache,
+    }
+    prompts = load_prompts(args.prompts)
+
+    # every worker process loads its own copy of the model once,
+    # spawned rather than forked since cuda can't be used in a forked child
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(config,),
+    ) as executor:
+        futures = [
+            executor.submit(_apply_one, filename, image_prompts)
+            for filename, image_prompts in prompts.items()
+        ]
+        for i, future in enumerate(futures):
+            print(f"[{i + 1}/{len(futures)}] {future.result()}")
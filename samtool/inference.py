@@ -0,0 +1,153 @@
+import argparse
+import contextlib
+
+import numpy as np
+import torch
+
+_DTYPES = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+
+class InferenceConfig:
+    """InferenceConfig.
+
+    Collects the torch level optimizations applied to the SAM model.
+    The defaults reproduce plain fp32 eager inference.
+    """
+
+    def __init__(
+        self,
+        device: None | str = None,
+        dtype: str = "fp32",
+        quantize: bool = False,
+        channels_last: bool = False,
+        compile: bool = False,
+        num_threads: None | int = None,
+        num_interop_threads: None | int = None,
+    ):
+        """__init__.
+
+        Args:
+            device (None | str): device to run on, defaults to cuda if available
+            dtype (str): autocast dtype, one of `fp32`, `fp16` or `bf16`
+            quantize (bool): dynamic int8 quantization of the image encoder linear layers, cpu only
+            channels_last (bool): use the channels last memory format for the image encoder
+            compile (bool): compile the image encoder with `torch.compile`
+            num_threads (None | int): number of intra-op threads
+            num_interop_threads (None | int): number of inter-op threads
+        """
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.dtype = dtype
+        self.quantize = quantize
+        self.channels_last = channels_last
+        self.compile = compile
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+
+        if dtype not in _DTYPES:
+            raise ValueError(f"Unknown dtype {dtype}, expected one of {list(_DTYPES)}.")
+        if dtype == "fp16" and self.device == "cpu":
+            raise ValueError(
+                "fp16 autocast is only supported on cuda, use bf16 on cpu."
+            )
+        if quantize and self.device != "cpu":
+            raise ValueError("Dynamic int8 quantization is only supported on cpu.")
+        if quantize and dtype != "fp32":
+            # autocast would feed reduced precision activations into the quantized linears, which expect fp32
+            raise ValueError(
+                "Dynamic int8 quantization can't be combined with autocast, use dtype fp32."
+            )
+
+    @staticmethod
+    def add_arguments(parser: argparse.ArgumentParser) -> None:
+        """Adds the inference options to a command line parser."""
+        group = parser.add_argument_group("inference")
+        group.add_argument("--device", default=None)
+        group.add_argument("--dtype", default="fp32", choices=list(_DTYPES))
+        group.add_argument("--quantize", default=False, action="store_true")
+        group.add_argument("--channels-last", default=False, action="store_true")
+        group.add_argument("--compile", default=False, action="store_true")
+        group.add_argument("--num-threads", type=int, default=None)
+        group.add_argument("--num-interop-threads", type=int, default=None)
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "InferenceConfig":
+        """Builds the config from arguments added with `add_arguments`."""
+        return cls(
+            device=args.device,
+            dtype=args.dtype,
+            quantize=args.quantize,
+            channels_last=args.channels_last,
+            compile=args.compile,
+            num_threads=args.num_threads,
+            num_interop_threads=args.num_interop_threads,
+        )
+
+    def apply_threads(self) -> None:
+        """Pins the torch thread pools, must be called before any parallel work starts."""
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        if self.num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(self.num_interop_threads)
+            except RuntimeError:
+                # the inter-op pool can only be sized once per process
+                pass
+
+    def prepare(self, sam: torch.nn.Module) -> torch.nn.Module:
+        """Moves the model to the device and applies the selected optimizations."""
+        self.apply_threads()
+        sam.to(self.device)
+        sam.eval()
+
+        if self.quantize:
+            sam.image_encoder = torch.ao.quantization.quantize_dynamic(
+                sam.image_encoder, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        if self.channels_last:
+            sam.image_encoder = sam.image_encoder.to(memory_format=torch.channels_last)
+        if self.compile:
+            sam.image_encoder = torch.compile(sam.image_encoder)
+
+        return sam
+
+    def context(self) -> contextlib.AbstractContextManager:
+        """Context to run the mask decoder in."""
+        return torch.inference_mode()
+
+    def encoder_context(self) -> contextlib.ExitStack:
+        """Context to run the image encoder in, adds autocast to inference mode."""
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode())
+        if self.dtype != "fp32":
+            stack.enter_context(
+                torch.autocast(
+                    device_type=self.device.split(":")[0], dtype=_DTYPES[self.dtype]
+                )
+            )
+        return stack
+
+    def set_image(self, predictor, image: np.ndarray) -> None:
+        """Computes the embeddings of an image on the predictor.
+
+        Only the image encoder runs in reduced precision, the embeddings are cast back to fp32
+        so the mask decoder and its outputs stay in full precision.
+        """
+        with self.encoder_context():
+            predictor.set_image(image)
+            predictor.features = predictor.features.float()
+
+    def warmup(self, predictor) -> None:
+        """Runs a dummy image through the predictor so compilation happens on startup."""
+        image = np.zeros((predictor.model.image_encoder.img_size,) * 2 + (3,), np.uint8)
+        self.set_image(predictor, image)
+        with self.context():
+            predictor.predict(
+                point_coords=np.array([[image.shape[1] // 2, image.shape[0] // 2]]),
+                point_labels=np.array([1]),
+                multimask_output=False,
+            )
+        predictor.reset_image()
@@ -0,0 +1,336 @@
+import contextlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Iterable
+
+_logger = logging.getLogger(__name__)
+
+
+def default_owner() -> str:
+    """An owner name that is unique to this process on this machine."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseCoordinator(ABC):
+    """LeaseCoordinator.
+
+    Hands out images to annotation instances so no two instances work on the same image.
+    A lease expires unless its owner renews it, so the images of an instance that went away
+    are handed out again. Images that are completed are never handed out again.
+    """
+
+    @abstractmethod
+    def acquire(
+        self, owner: str, candidates: Iterable[str], count: int, ttl: float
+    ) -> list[str]:
+        """Leases up to count candidates that are not completed or leased by anyone else.
+
+        Args:
+            owner (str): name of the instance taking the lease
+            candidates (Iterable[str]): images in the order they should be handed out
+            count (int): maximum number of images to lease
+            ttl (float): seconds until the lease expires without a renewal
+
+        Returns:
+            list[str]: the newly leased images, in candidate order
+        """
+
+    @abstractmethod
+    def held(self, owner: str) -> list[str]:
+        """Lists the uncompleted images an owner still holds, eg: to resume after a restart.
+
+        Expired leases that nobody has taken over yet are still held, the next renewal revives them.
+        """
+
+    @abstractmethod
+    def renew(self, owner: str, ttl: float) -> None:
+        """Extends all uncompleted leases still held by an owner by ttl seconds from now.
+
+        Leases that expired but were not taken over by anyone else are revived.
+        """
+
+    @abstractmethod
+    def complete(self, owner: str, images: Iterable[str]) -> list[str]:
+        """Marks leased images as completed.
+
+        Returns:
+            list[str]: the images that were marked, images now leased to another owner are left alone
+        """
+
+    @abstractmethod
+    def release(self, owner: str) -> None:
+        """Gives up all uncompleted leases of an owner so others can take them right away."""
+
+    def close(self) -> None:
+        """Releases any resources held by the coordinator."""
+
+
+class MemoryCoordinator(LeaseCoordinator):
+    """MemoryCoordinator.
+
+    Keeps leases in memory, a stand-in for a shared coordinator when all instances
+    live in one process, eg: for local runs and testing.
+    """
+
+    def __init__(self):
+        """__init__."""
+        self._lock = threading.Lock()
+        # image -> (owner, expiry time, completed)
+        self._leases: dict[str, tuple[str, float, bool]] = {}
+
+    def acquire(
+        self, owner: str, candidates: Iterable[str], count: int, ttl: float
+    ) -> list[str]:
+        with self._lock:
+            now = time.time()
+            chosen = []
+            for image in candidates:
+                if len(chosen) >= count:
+                    break
+                lease = self._leases.get(image)
+                if lease is not None and (lease[2] or lease[1] > now):
+                    continue
+                self._leases[image] = (owner, now + ttl, False)
+                chosen.append(image)
+            return chosen
+
+    def held(self, owner: str) -> list[str]:
+        with self._lock:
+            return [
+                image
+                for image, (o, _, done) in self._leases.items()
+                if o == owner and not done
+            ]
+
+    def renew(self, owner: str, ttl: float) -> None:
+        with self._lock:
+            now = time.time()
+            for image, (o, _, done) in self._leases.items():
+                if o == owner and not done:
+                    self._leases[image] = (o, now + ttl, done)
+
+    def complete(self, owner: str, images: Iterable[str]) -> list[str]:
+        completed = []
+        with self._lock:
+            for image in images:
+                lease = self._leases.get(image)
+                if lease is not None and lease[0] == owner:
+                    self._leases[image] = (owner, lease[1], True)
+                    completed.append(image)
+        return completed
+
+    def release(self, owner: str) -> None:
+        with self._lock:
+            for image, (o, _, done) in list(self._leases.items()):
+                if o == owner and not done:
+                    del self._leases[image]
+
+
+class SQLiteCoordinator(LeaseCoordinator):
+    """SQLiteCoordinator.
+
+    Keeps leases in a sqlite file on storage shared by all instances, eg: next to the labels on NFS.
+    Every change runs in an immediate transaction, so the sqlite file lock serialises instances.
+    Expiry times come from the clock of each machine, so the ttl should be far longer than any clock skew.
+    """
+
+    def __init__(self, path: str):
+        """__init__.
+
+        Args:
+            path (str): path to the sqlite file, created if it doesn't exist
+        """
+        self.path = path
+
+        # wal needs shared memory, which network filesystems don't provide
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=60.0, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=DELETE")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS leases (
+                image TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL,
+                done INTEGER NOT NULL
+            )""")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # take the write lock up front so two instances can't pick the same images
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            else:
+                self._connection.execute("COMMIT")
+
+    def acquire(
+        self, owner: str, candidates: Iterable[str], count: int, ttl: float
+    ) -> list[str]:
+        with self._transaction() as connection:
+            now = time.time()
+            taken = {
+                image
+                for (image,) in connection.execute(
+                    "SELECT image FROM leases WHERE done = 1 OR expires > ?", (now,)
+                )
+            }
+
+            chosen = []
+            for image in candidates:
+                if len(chosen) >= count:
+                    break
+                if image not in taken:
+                    chosen.append(image)
+
+            # expired leases are simply taken over
+            connection.executemany(
+                "INSERT OR REPLACE INTO leases VALUES (?, ?, ?, 0)",
+                [(image, owner, now + ttl) for image in chosen],
+            )
+        return chosen
+
+    def held(self, owner: str) -> list[str]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT image FROM leases WHERE owner = ? AND done = 0 ORDER BY image",
+                (owner,),
+            ).fetchall()
+        return [image for (image,) in rows]
+
+    def renew(self, owner: str, ttl: float) -> None:
+        with self._transaction() as connection:
+            now = time.time()
+            connection.execute(
+                "UPDATE leases SET expires = ? WHERE owner = ? AND done = 0",
+                (now + ttl, owner),
+            )
+
+    def complete(self, owner: str, images: Iterable[str]) -> list[str]:
+        completed = []
+        with self._transaction() as connection:
+            for image in images:
+                cursor = connection.execute(
+                    "UPDATE leases SET done = 1 WHERE image = ? AND owner = ?",
+                    (image, owner),
+                )
+                if cursor.rowcount > 0:
+                    completed.append(image)
+        return completed
+
+    def release(self, owner: str) -> None:
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM leases WHERE owner = ? AND done = 0", (owner,)
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def open_coordinator(location: None | str) -> LeaseCoordinator:
+    """Opens a coordinator, a sqlite file on shared storage, or an in memory one if location is None."""
+    if location is None:
+        return MemoryCoordinator()
+    return SQLiteCoordinator(location)
+
+
+class Lease:
+    """Lease.
+
+    The batch of images leased by one instance. The lease is renewed on a background
+    thread for as long as the instance runs, and grows a batch at a time as images are completed.
+    """
+
+    def __init__(
+        self,
+        coordinator: LeaseCoordinator,
+        owner: None | str = None,
+        batch_size: int = 32,
+        ttl: float = 600.0,
+    ):
+        """__init__.
+
+        Args:
+            coordinator (LeaseCoordinator): the coordinator shared by all instances
+            owner (None | str): name of this instance, defaults to the hostname and process id
+            batch_size (int): number of images leased at a time
+            ttl (float): seconds a lease lives without a heartbeat
+        """
+        self.coordinator = coordinator
+        self.owner = owner or default_owner()
+        self.batch_size = batch_size
+        self.ttl = ttl
+
+        # leases that survived a restart of the same owner are picked up again
+        self.images: list[str] = coordinator.held(self.owner)
+        self._completed: set[str] = set()
+
+        # heartbeat a few times per ttl so one missed beat doesn't lose the lease
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+
+    def _beat(self) -> None:
+        while not self._stop.wait(self.ttl / 3.0):
+            # a failed beat, eg: a locked database or a stale nfs handle, is retried on the next one
+            try:
+                self.coordinator.renew(self.owner, self.ttl)
+            except Exception:
+                _logger.exception("Failed to renew the leases of %s.", self.owner)
+
+    def extend(self, candidates: Iterable[str]) -> list[str]:
+        """Leases the next batch of images.
+
+        Args:
+            candidates (Iterable[str]): images that still need work, in the order they should be handed out
+
+        Returns:
+            list[str]: the newly leased images, also appended to `images`
+        """
+        held = set(self.images)
+        new = self.coordinator.acquire(
+            self.owner,
+            (image for image in candidates if image not in held),
+            self.batch_size,
+            self.ttl,
+        )
+        self.images += new
+        return new
+
+    def complete(self, images: Iterable[str]) -> None:
+        """Marks images as completed so they are never handed out again."""
+        self._completed.update(self.coordinator.complete(self.owner, images))
+
+    def holds(self, image: str) -> bool:
+        """Whether an image is still leased to, or was completed by, this instance."""
+        return image in self._completed or image in self.coordinator.held(self.owner)
+
+    def refresh(self) -> list[str]:
+        """Drops images whose lease was lost, eg: because it expired and another instance took it.
+
+        Returns:
+            list[str]: the images that were dropped from `images`
+        """
+        held = set(self.coordinator.held(self.owner)) | self._completed
+        lost = [image for image in self.images if image not in held]
+
+        # in place, since `FileSeeker` shares the list
+        if lost:
+            self.images[:] = [image for image in self.images if image in held]
+        return lost
+
+    def close(self) -> None:
+        """Stops the heartbeat and hands uncompleted images back."""
+        self._stop.set()
+        self.coordinator.release(self.owner)
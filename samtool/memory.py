@@ -0,0 +1,225 @@
+import collections
+import threading
+from typing import Any, Callable, Hashable
+
+import numpy as np
+
+
+def nbytes(value: Any) -> int:
+    """Approximate number of bytes held by arrays and tensors, looking inside dicts, lists and tuples."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, "element_size") and hasattr(value, "nelement"):
+        return value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    return 0
+
+
+class MemoryBudget:
+    """MemoryBudget.
+
+    A single byte budget shared by several caches. Whenever the caches together go over the budget,
+    the largest cache gives up its oldest entries first. Memory that can't be given up, eg: render buffers,
+    is tracked as well so it counts against the budget and shows up in the report.
+    """
+
+    def __init__(self, total: int = 2 << 30):
+        """__init__.
+
+        Args:
+            total (int): number of bytes all caches together may hold
+        """
+        self.total = total
+        self._caches: dict[str, "LRUCache"] = {}
+        self._fixed: dict[str, Callable[[], int]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, cache: "LRUCache") -> None:
+        """Adds a cache whose entries can be evicted to stay within the budget."""
+        with self._lock:
+            self._caches[name] = cache
+
+    def track(self, name: str, usage: Callable[[], int]) -> None:
+        """Adds memory that counts against the budget but can't be evicted.
+
+        Args:
+            name (str): name in the report
+            usage (Callable[[], int]): returns the current number of bytes
+        """
+        with self._lock:
+            self._fixed[name] = usage
+
+    def usage(self) -> dict[str, int]:
+        """Current number of bytes held, per cache."""
+        with self._lock:
+            usage = {name: cache.nbytes for name, cache in self._caches.items()}
+            usage.update({name: fn() for name, fn in self._fixed.items()})
+        return usage
+
+    def enforce(self) -> None:
+        """Evicts entries, from the largest cache first, until the total is within the budget."""
+        with self._lock:
+            fixed = sum(fn() for fn in self._fixed.values())
+            while True:
+                sizes = {name: cache.nbytes for name, cache in self._caches.items()}
+                if fixed + sum(sizes.values()) <= self.total:
+                    return
+
+                # caches keep their newest entry, so eventually nothing is left to evict
+                for name in sorted(sizes, key=sizes.get, reverse=True):
+                    if self._caches[name].evict():
+                        break
+                else:
+                    return
+
+    def report(self) -> str:
+        """A human readable summary of the usage per cache."""
+        usage = self.usage()
+        lines = [f"{name}: {size / (1 << 20):.1f} MB" for name, size in usage.items()]
+        lines.append(
+            f"total: {sum(usage.values()) / (1 << 20):.1f} of {self.total / (1 << 20):.1f} MB"
+        )
+        return "\n".join(lines)
+
+
+class LRUCache:
+    """LRUCache.
+
+    A least recently used cache that counts the bytes of its entries against a shared `MemoryBudget`.
+    The newest entry is never evicted by the budget, so the entry in use always stays.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        budget: None | MemoryBudget = None,
+        max_entries: None | int = None,
+    ):
+        """__init__.
+
+        Args:
+            name (str): name of the cache in the budget report
+            budget (None | MemoryBudget): the budget to count against, or None for no byte limit
+            max_entries (None | int): maximum number of entries, or None for no limit
+        """
+        self.name = name
+        self.budget = budget
+        self.max_entries = max_entries
+        self._entries: collections.OrderedDict[Hashable, tuple[Any, int]] = (
+            collections.OrderedDict()
+        )
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+        if budget is not None:
+            budget.register(name, self)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def keys(self) -> list[Hashable]:
+        """The keys from the oldest to the newest."""
+        with self._lock:
+            return list(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns an entry and marks it as the most recently used."""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Returns an entry without marking it as used."""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._entries[key][0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Adds an entry as the most recently used, evicting old entries if needed."""
+        with self._lock:
+            self._discard(key)
+            size = nbytes(value)
+            self._entries[key] = (value, size)
+            self._nbytes += size
+            while (
+                self.max_entries is not None and len(self._entries) > self.max_entries
+            ):
+                self._nbytes -= self._entries.popitem(last=False)[1][1]
+
+        # outside the lock, the budget may evict from this cache as well
+        if self.budget is not None:
+            self.budget.enforce()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Removes an entry and returns it."""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries[key][0]
+            self._discard(key)
+            return value
+
+    def evict(self) -> bool:
+        """Removes the oldest entry, unless it is the only one.
+
+        Returns:
+            bool: whether an entry was removed
+        """
+        with self._lock:
+            if len(self._entries) <= 1:
+                return False
+            self._nbytes -= self._entries.popitem(last=False)[1][1]
+            return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _discard(self, key: Hashable) -> None:
+        if key in self._entries:
+            self._nbytes -= self._entries.pop(key)[1]
+
+
+class RenderBuffers:
+    """RenderBuffers.
+
+    A small ring of preallocated image buffers, so renders reuse memory instead of allocating
+    a full frame every time. A buffer is only handed out again after count - 1 other renders,
+    so with one more buffer than requests that may be sent at once, no render is overwritten while it is being sent.
+    """
+
+    def __init__(self, count: int = 2):
+        """__init__.
+
+        Args:
+            count (int): number of buffers in the ring, one more than the number of renders that may be in flight
+        """
+        self._buffers: list[np.ndarray] = [np.zeros((0,), dtype=np.uint8)] * count
+        self._index = 0
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self._buffers)
+
+    def next(self, shape: tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        """Returns the next buffer in the ring, only allocating if the shape changed."""
+        self._index = (self._index + 1) % len(self._buffers)
+        buffer = self._buffers[self._index]
+        if buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[self._index] = buffer
+        return buffer
@@ -0,0 +1,87 @@
+import argparse
+import os
+
+import yaml
+
+from samtool.inference import InferenceConfig
+from samtool.sammer import Sammer
+from samtool.storage import label_key
+from samtool.weights import add_arguments as add_checkpoint_arguments
+
+
+def propagate_sequence(
+    sam: Sammer,
+    filenames: list[str],
+    overwrite: bool = False,
+    num_points: int = 1,
+    min_area: int = 64,
+) -> int:
+    """Propagates labels forward through a sequence of frames.
+
+    Each frame without a label receives a proposed label derived from the frame before it,
+    so a single labelled frame seeds every unlabelled frame that follows it.
+
+    Args:
+        sam (Sammer): the sammer holding the model and label paths
+        filenames (list[str]): the frames in sequence order
+        overwrite (bool): whether to replace labels that already exist
+        num_points (int): number of interior points sampled per component
+        min_area (int): components smaller than this many pixels are ignored
+
+    Returns:
+        int: number of labels proposed
+    """
+    proposed = 0
+    for source_filename, filename in zip(filenames[:-1], filenames[1:]):
+        if not overwrite and sam.store.exists(label_key(filename), sam.num_labels):
+            continue
+
+        # the source needs a label, which may itself have been propagated
+        if not sam.store.exists(label_key(source_filename), sam.num_labels):
+            continue
+
+        sam.reset(filename)
+        if sam.propagate(
+            filename,
+            source_filename,
+            num_points=num_points,
+            min_area=min_area,
+            overwrite=overwrite,
+        ):
+            proposed += 1
+            print(f"Proposed label for {filename} from {source_filename}.")
+
+    return proposed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="SAMTool Propagate",
+        description="Propagates labels between consecutive frames of an image directory.",
+    )
+    parser.add_argument("--imagedir", required=True)
+    parser.add_argument("--labeldir", required=True)
+    parser.add_argument("--annotations", required=True)
+    parser.add_argument("--overwrite", default=False, action="store_true")
+    parser.add_argument("--num-points", type=int, default=1)
+    parser.add_argument("--min-area", type=int, default=64)
+    InferenceConfig.add_arguments(parser)
+    add_checkpoint_arguments(parser)
+    args = parser.parse_args()
+
+    sam = Sammer(
+        yaml.safe_load(open(args.annotations)),
+        args.imagedir,
+        args.labeldir,
+        inference=InferenceConfig.from_args(args),
+        checkpoint=args.checkpoint,
+        cache_dir=args.cache_dir,
+    )
+    proposed = propagate_sequence(
+        sam,
+        sorted(os.listdir(args.imagedir)),
+        overwrite=args.overwrite,
+        num_points=args.num_points,
+        min_area=args.min_area,
+    )
+    print(f"Proposed {proposed} labels.")
@@ -1,4 +1,8 @@
+import bisect
+import itertools
+import math
 import os
+import threading
 
 import cv2
 import numpy as np
@@ -6,9 +10,39 @@ import torch
 import yaml
 from segment_anything import SamPredictor, sam_model_registry
 
-from samtool.colors import colors
-from samtool.utils import (delete_label, label_exists, retrieve_label,
-                           save_label)
+from samtool.colors import palette
+from samtool.dedup import DuplicateIndex
+from samtool.embeddings import EmbeddingCache, embedding_key
+from samtool.inference import InferenceConfig
+from samtool.leases import Lease
+from samtool.memory import LRUCache, MemoryBudget, RenderBuffers, nbytes
+from samtool.storage import LabelStore, label_key, open_store
+from samtool.utils import mask_bbox
+from samtool.weights import fetch_checkpoint
+
+
+def load_predictor(
+    inference: InferenceConfig,
+    checkpoint: None | str = None,
+    cache_dir: None | str = None,
+) -> SamPredictor:
+    """Loads the SAM model, downloading the weights if needed, and wraps it in a predictor.
+
+    Args:
+        inference (InferenceConfig): the optimizations to apply to the model
+        checkpoint (None | str): path to the weights, downloaded into the cache if not given
+        cache_dir (None | str): directory to download the weights to
+
+    Returns:
+        SamPredictor:
+    """
+    if checkpoint is None:
+        checkpoint = fetch_checkpoint(cache_dir=cache_dir)
+
+    # load the model and move them to device
+    sam = sam_model_registry["vit_l"](checkpoint=checkpoint)
+    sam = inference.prepare(sam)
+    return SamPredictor(sam)
 
 
 class FileSeeker:
@@ -17,16 +51,91 @@ class FileSeeker:
     Handles searching for next and previous files.
     """
 
-    def __init__(self, images_path: str, labels_path: str, annotations_path: str):
-        """__init__."""
+    def __init__(
+        self,
+        images_path: str,
+        labels_path: str,
+        annotations_path: str,
+        duplicate_index: None | DuplicateIndex = None,
+        lease: None | Lease = None,
+    ):
+        """__init__.
+
+        Args:
+            images_path (str): directory of the images on the disk
+            labels_path (str): directory of the labels on the disk, or a sqlite label store
+            annotations_path (str): path to the annotations yaml file
+            duplicate_index (None | DuplicateIndex): if given, near-duplicates are skipped when seeking
+            lease (None | Lease): if given, only images leased to this instance are visited
+        """
         self.images_path = images_path
         self.labels_path = labels_path
+        self.store: LabelStore = open_store(labels_path)
 
         self.all_images = os.listdir(images_path)
         self.all_labels = yaml.safe_load(open(annotations_path))
 
+        # frames of a sequence are ordered by name, whatever order the images are visited in
+        self.frames = sorted(self.all_images)
+        self.duplicate_index = duplicate_index
+
+        # with a lease the images are handed out a batch at a time
+        self.lease = lease
+        if self.lease is not None:
+            if len(self.lease.images) == 0:
+                self.lease.extend(self._unleased())
+            self.all_images = self.lease.images
+
+    def _unleased(self) -> list[str]:
+        """Images that still need work, in the order they are leased."""
+        labelled = set(self.store.keys())
+        return [
+            filename
+            for filename in sorted(os.listdir(self.images_path))
+            if label_key(filename) not in labelled
+            and (
+                self.duplicate_index is None
+                or not self.duplicate_index.is_redundant(filename)
+            )
+        ]
+
+    def extend_lease(self) -> bool:
+        """Completes the labelled images of the lease and leases another batch.
+
+        Returns:
+            bool: whether any new images were leased
+        """
+        if self.lease is None:
+            return False
+
+        self.lease.complete(
+            f
+            for f in self.all_images
+            if self.store.exists(label_key(f), len(self.all_labels))
+        )
+        return len(self.lease.extend(self._unleased())) > 0
+
+    def owns(self, filename: str) -> bool:
+        """Whether this instance may edit the label of an image, always true without a lease."""
+        return self.lease is None or self.lease.holds(filename)
+
+    def progress(self) -> str:
+        """A summary of how many images are labelled."""
+        if self.lease is None:
+            return f"{self.store.count()} of {len(self.all_images)} completed."
+
+        done = sum(
+            self.store.exists(label_key(f), len(self.all_labels))
+            for f in self.all_images
+        )
+        return f"{done} of {len(self.all_images)} leased images completed."
+
     # next file previous file
     def file_increment(self, ascend: bool, unlabelled_only: bool, filename: str):
+        # images whose lease was lost are handed to someone else, so stop visiting them
+        if self.lease is not None:
+            self.lease.refresh()
+
         try:
             index = self.all_images.index(filename)
         except ValueError:
@@ -35,31 +144,83 @@ class FileSeeker:
         while True:
             index += 1 if ascend else -1
 
+            # lease more images once the end of the lease is reached
+            if ascend and index >= len(self.all_images):
+                self.extend_lease()
+
             # don't exceed index
             if index <= -1 or index >= len(self.all_images):
                 index += 1 if not ascend else -1
                 break
 
+            # skip images that are near-duplicates of an earlier one
+            if self.duplicate_index is not None and self.duplicate_index.is_redundant(
+                self.all_images[index]
+            ):
+                continue
+
             # we don't care if labelled of unlabelled
             if not unlabelled_only:
                 break
 
             # we only care if unlabelled
-            if label_exists(
-                labeldir=self.labels_path,
-                image_filename=filename,
-                num_channels=len(self.all_labels),
+            if not self.store.exists(
+                label_key(self.all_images[index]), len(self.all_labels)
             ):
                 break
 
         return self.all_images[index]
 
+    def previous_frame(self, filename: str) -> None | str:
+        """Returns the image before this one in name order, the previous frame of a sequence."""
+        index = bisect.bisect_left(self.frames, filename)
+        if index == 0:
+            return None
+        return self.frames[index - 1]
+
+    def labelled_neighbour(self, filename: str) -> None | str:
+        """Returns the nearest near-duplicate of this image that already has a label."""
+        if self.duplicate_index is None or filename not in self.duplicate_index:
+            return None
+
+        for neighbour in self.duplicate_index.neighbours(filename):
+            if self.store.exists(label_key(neighbour), len(self.all_labels)):
+                return neighbour
+        return None
+
 
 class Sammer:
     """Sammer."""
 
-    def __init__(self, labels: dict[str, int], images_path: str, labels_path: str):
-        """__init__."""
+    def __init__(
+        self,
+        labels: dict[str, int],
+        images_path: str,
+        labels_path: str,
+        inference: None | InferenceConfig = None,
+        warmup: bool = False,
+        checkpoint: None | str = None,
+        cache_dir: None | str = None,
+        background_load: bool = False,
+        embedding_cache: None | EmbeddingCache = None,
+        memory_budget: None | MemoryBudget = None,
+        render_buffers: int = 2,
+    ):
+        """__init__.
+
+        Args:
+            labels (dict[str, int]): mapping of label names to channel indices
+            images_path (str): directory of the images on the disk
+            labels_path (str): directory of the labels on the disk, or a sqlite label store
+            inference (None | InferenceConfig): torch optimizations, defaults to plain fp32
+            warmup (bool): run a dummy image through the model on startup
+            checkpoint (None | str): path to the weights, downloaded into the cache if not given
+            cache_dir (None | str): directory to download the weights to
+            background_load (bool): load the model on a background thread, anything using it waits until it is ready
+            embedding_cache (None | EmbeddingCache): cache for image embeddings, defaults to a small in memory cache
+            memory_budget (None | MemoryBudget): budget shared by the image, embedding and undo caches, defaults to 2GB
+            render_buffers (int): number of reused buffers per render target, one more than the renders that may be sent at once
+        """
         # check the validity of the labels
         labels_check = list(labels.values())
         assert all(isinstance(i, int) for i in list(labels.values()))
@@ -72,81 +233,215 @@ class Sammer:
         # store paths
         self.images_path = images_path
         self.labels_path = labels_path
+        self.store: LabelStore = open_store(labels_path)
 
-        # store the base image and mask
+        # store the base image and mask, the part mask is cropped to its bounding box
         self.base_image: np.ndarray = np.array([])
         self.part_mask: np.ndarray = np.array(None)
+        self.part_bbox: None | tuple[int, int, int, int] = None
+        self.filename: None | str = None
+
+        # low resolution decoder output for the part mask, and the downscaled base image to preview it on
+        self._part_logits: None | torch.Tensor = None
+        self._preview: tuple[tuple, np.ndarray] = ((), np.array([]))
+
+        # cache of the complete mask and its rendering for the current image
+        self.comp_filename: None | str = None
+        self.comp_mask: None | np.ndarray = None
+        self.comp_image: np.ndarray = np.array([])
 
         # storage for points and validities
         self.coords = list()
         self.validity = list()
 
-        this_file_path = os.path.dirname(os.path.abspath(__file__))
+        # everything that grows over a session shares one memory budget
+        self.memory = memory_budget or MemoryBudget()
+        self.image_cache = LRUCache("images", budget=self.memory)
+        self.history = LRUCache("undo", budget=self.memory)
+        self._history_ids = itertools.count()
+
+        # renders reuse full frame buffers instead of allocating new ones
+        self._part_buffers = RenderBuffers(render_buffers)
+        self._comp_buffers = RenderBuffers(render_buffers)
+        self.memory.track(
+            "render buffers",
+            lambda: self._part_buffers.nbytes + self._comp_buffers.nbytes,
+        )
+        self.memory.track(
+            "current label", lambda: nbytes(self.comp_mask) + nbytes(self.part_mask)
+        )
+        self.memory.track("preview", lambda: nbytes(self._preview[1]))
+
+        # load the model
+        self.inference = inference or InferenceConfig()
+        self.embedding_cache = embedding_cache or EmbeddingCache(budget=self.memory)
+        self._predictor: None | SamPredictor = None
+        self._predictor_error: None | BaseException = None
+        self._predictor_ready = threading.Event()
+
+        def load():
+            try:
+                self._predictor = load_predictor(
+                    self.inference, checkpoint=checkpoint, cache_dir=cache_dir
+                )
+                if warmup:
+                    self.inference.warmup(self._predictor)
+            except BaseException as e:
+                self._predictor_error = e
+            finally:
+                self._predictor_ready.set()
+
+        if background_load:
+            threading.Thread(target=load, name="samtool-load", daemon=True).start()
+        else:
+            load()
+            if self._predictor_error is not None:
+                raise self._predictor_error
 
-        # downlaod the model if it doesn't exist
-        if not os.path.isfile(os.path.join(this_file_path, "sam_vit_l_0b3195.pth")):
-            print(
-                "Model weights not found, downloading them from `https://dl.fbaipublicfiles.com/segment_anything/sam_vit_l_0b3195.pth`..."
-            )
-            import wget
+    @property
+    def predictor(self) -> SamPredictor:
+        """The SAM predictor, blocks until the model has finished loading."""
+        self._predictor_ready.wait()
+        if self._predictor_error is not None:
+            raise RuntimeError(
+                "The SAM model failed to load."
+            ) from self._predictor_error
+        return self._predictor
 
-            wget.download(
-                "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_l_0b3195.pth",
-                out=this_file_path,
-            )
+    @property
+    def model_ready(self) -> bool:
+        """Whether the model has finished loading."""
+        return self._predictor_ready.is_set()
 
-        # load the model and move them to device
-        sam = sam_model_registry["vit_l"](
-            checkpoint=os.path.join(this_file_path, "sam_vit_l_0b3195.pth")
-        )
-        sam.to("cuda" if torch.cuda.is_available() else "cpu")
-        self.predictor = SamPredictor(sam)
+    @staticmethod
+    def open(image: str | np.ndarray, **kwargs):
+        """Opens a headless annotation session on a single image.
+
+        Example:
+            session = Sammer.open("image.jpg", labels=labels, store=open_store(labeldir))
+            session.predict(points=np.array([[[100, 200]]]))
+            session.commit("cat")
+
+        Args:
+            image (str | np.ndarray): path to an image, or an RGB image array
+            **kwargs: passed on to `samtool.headless.Session`
+
+        Returns:
+            Session:
+        """
+        from samtool.headless import Session
+
+        return Session(image, **kwargs)
 
     @property
     def num_labels(self):
         return len(self.labels)
 
     def reset(self, filename: str, compute_embeddings: bool = True):
-        # update the base image
-        imagefile = os.path.join(self.images_path, filename)
-        self.base_image = cv2.imread(imagefile)
-        self.base_image = cv2.cvtColor(self.base_image, cv2.COLOR_BGR2RGB)
+        # update the base image, no need to read it again if it hasn't changed
+        if filename != self.filename:
+            # drop everything of the previous image before loading the next one
+            if self._predictor is not None:
+                self._predictor.reset_image()
+            self._invalidate_comp()
+            self.comp_image = np.array([])
+
+            image = self.image_cache.get(filename)
+            if image is None:
+                imagefile = os.path.join(self.images_path, filename)
+                image = cv2.cvtColor(cv2.imread(imagefile), cv2.COLOR_BGR2RGB)
+                self.image_cache.put(filename, image)
+            self.base_image = image
+            self.filename = filename
 
         # reset the part mask
         self.part_mask = np.array(None)
+        self.part_bbox = None
+        self._part_logits = None
 
         # compute the embeddings using the image
         if compute_embeddings:
-            self.predictor.set_image(self.base_image)
+            self.embedding_cache.set_image(
+                self.inference,
+                self.predictor,
+                self.base_image,
+                key=embedding_key(os.path.join(self.images_path, filename)),
+            )
 
         return self.base_image
 
     def get_comp_image(self, filename: str) -> np.ndarray:
-        image = self.base_image
+        self._load_comp(filename)
+        return self.comp_image
+
+    def _load_comp(self, filename: str):
+        """Loads the complete mask of an image and renders it, unless it is already cached."""
+        if self.comp_filename == filename:
+            return
 
         # check if we have a complete mask
-        if label_exists(
-            labeldir=self.labels_path,
-            image_filename=filename,
-            num_channels=self.num_labels,
-        ):
-            # draw the masks if we have it
-            comp_mask = retrieve_label(
-                labeldir=self.labels_path,
-                image_filename=filename,
-            )
-            for i, mask in enumerate(np.moveaxis(comp_mask, -1, 0).copy()):
-                image = self.show_mask(image, mask, i)
+        if self.store.exists(label_key(filename), self.num_labels):
+            self.comp_mask = self.store.retrieve(label_key(filename))
+        else:
+            self.comp_mask = None
 
-        return image
+        self.comp_filename = filename
+        self.comp_image = self.base_image
+        self._redraw_comp((0, self.base_image.shape[0], 0, self.base_image.shape[1]))
+
+    def _redraw_comp(self, bbox: tuple[int, int, int, int]):
+        """Redraws the complete image only within a dirty rectangle.
+
+        Args:
+            bbox (tuple[int, int, int, int]): (y0, y1, x0, x1) of the dirty rectangle
+        """
+        y0, y1, x0, x1 = bbox
+        image = self.base_image[y0:y1, x0:x1]
+        if self.comp_mask is not None:
+            image = self.show_masks(image, self.comp_mask[y0:y1, x0:x1])
+
+        # copy on write, the previous image may still be in the process of being sent
+        buffer = self._comp_buffers.next(self.base_image.shape)
+        np.copyto(buffer, self.comp_image)
+        buffer[y0:y1, x0:x1] = image
+        self.comp_image = buffer
+
+    def _invalidate_comp(self):
+        """Drops the cached complete mask, for when the whole label is rewritten."""
+        self.comp_filename = None
+        self.comp_mask = None
 
     def clear_coords_validity_part(self) -> np.ndarray:
         self.coords = list()
         self.validity = list()
         self.part_mask = np.array(None)
+        self.part_bbox = None
+        self._part_logits = None
 
         return self.base_image
 
+    def set_part_mask(self, mask: np.ndarray, offset: tuple[int, int] = (0, 0)):
+        """Sets the part mask, keeping only the bounding box of its contents.
+
+        Args:
+            mask (np.ndarray): (h, w) array of booleans
+            offset (tuple[int, int]): (y, x) position of the mask within the image
+        """
+        bbox = mask_bbox(mask)
+        if bbox is None:
+            self.part_mask = np.array(None)
+            self.part_bbox = None
+            return
+
+        y0, y1, x0, x1 = bbox
+        self.part_mask = mask[y0:y1, x0:x1]
+        self.part_bbox = (
+            y0 + offset[0],
+            y1 + offset[0],
+            x0 + offset[1],
+            x1 + offset[1],
+        )
+
     def add_coords_validity(self, coord: np.ndarray, validity: bool):
         """Adds the coords and validity to the currently tracked list, coords must be (2, ) array and validity must be a bool
 
@@ -163,101 +458,505 @@ class Sammer:
         Args:
             label (str): label
         """
-        assert label in self.labels
+        self.predict_part_mask()
+        return self.render_part_image(label)
+
+    def predict_part_mask(self) -> np.ndarray:
+        """Predicts the part mask from the currently tracked coords and validities.
+
+        Returns:
+            np.ndarray: (h, w) array of booleans cropped to `part_bbox`, or an empty array if there is no mask
+        """
+        self.decode_part_mask()
+        return self.upsample_part_mask()
+
+    def decode_part_mask(self) -> None:
+        """Runs only the mask decoder on the currently tracked coords and validities.
+
+        This is what `SamPredictor.predict` does before upsampling, the low resolution logits are kept
+        so a preview can be drawn from them before `upsample_part_mask` runs.
+        """
+        self._part_logits = None
+        if len(self.coords) == 0:
+            return
 
-        if len(self.coords) != 0:
-            # generate the new mask
-            masks, scores, logits = self.predictor.predict(
-                point_coords=np.array(self.coords),
-                point_labels=np.array(self.validity),
+        predictor = self.predictor
+        coords = predictor.transform.apply_coords(
+            np.array(self.coords, dtype=float), predictor.original_size
+        )
+        with self.inference.context():
+            points = (
+                torch.as_tensor(coords, dtype=torch.float, device=predictor.device)[
+                    None
+                ],
+                torch.as_tensor(
+                    self.validity, dtype=torch.int, device=predictor.device
+                )[None],
+            )
+            sparse, dense = predictor.model.prompt_encoder(
+                points=points, boxes=None, masks=None
+            )
+            self._part_logits, _ = predictor.model.mask_decoder(
+                image_embeddings=predictor.features,
+                image_pe=predictor.model.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse,
+                dense_prompt_embeddings=dense,
                 multimask_output=False,
             )
-            self.part_mask = masks[0]
 
-            # display the mask
-            return self.show_mask(self.base_image, self.part_mask, self.labels[label])
-        else:
-            return self.base_image
+    def upsample_part_mask(self) -> np.ndarray:
+        """Upsamples the logits from `decode_part_mask` into the full resolution part mask.
+
+        Returns:
+            np.ndarray: (h, w) array of booleans cropped to `part_bbox`, or an empty array if there is no mask
+        """
+        if self._part_logits is not None:
+            predictor = self.predictor
+            with self.inference.context():
+                masks = predictor.model.postprocess_masks(
+                    self._part_logits, predictor.input_size, predictor.original_size
+                )
+            self.set_part_mask(
+                (masks[0, 0] > predictor.model.mask_threshold).cpu().numpy()
+            )
+
+        return self.part_mask
+
+    def snap_stroke(self, stroke: np.ndarray, margin: float = 0.1, num_points: int = 8):
+        """Replaces a crayon stroke with the SAM mask it prompts, restricted to the region around the stroke.
+
+        The bounding box of the stroke padded by a margin is used as the box prompt,
+        and points spread along the stroke are used as positive point prompts.
+        Requires the embeddings for the current image.
+
+        Args:
+            stroke (np.ndarray): (H, W) array of booleans
+            margin (float): padding around the stroke as a fraction of its size
+            num_points (int): number of points taken along the stroke
+        """
+        bbox = mask_bbox(stroke)
+        if bbox is None:
+            self.set_part_mask(stroke)
+            return
+
+        # pad the stroke bounding box to get the region that the mask may cover
+        y0, y1, x0, x1 = bbox
+        pad_y, pad_x = int((y1 - y0) * margin), int((x1 - x0) * margin)
+        y0, y1 = max(y0 - pad_y, 0), min(y1 + pad_y, stroke.shape[0])
+        x0, x1 = max(x0 - pad_x, 0), min(x1 + pad_x, stroke.shape[1])
+
+        # spread points along the stroke
+        ys, xs = np.nonzero(stroke[y0:y1, x0:x1])
+        picks = np.linspace(0, len(xs) - 1, num=min(num_points, len(xs))).astype(int)
+        points = np.stack([xs[picks] + x0, ys[picks] + y0], axis=-1)
+
+        with self.inference.context():
+            masks, _, _ = self.predictor.predict(
+                point_coords=points,
+                point_labels=np.ones(len(points), dtype=int),
+                box=np.array([x0, y0, x1, y1]),
+                multimask_output=False,
+            )
+        self.set_part_mask(masks[0][y0:y1, x0:x1], offset=(y0, x0))
+
+    def render_part_image(self, label) -> np.ndarray:
+        """Draws the part mask over the base image.
+
+        Args:
+            label (str): label
+        """
+        assert label in self.labels
+
+        image = self.base_image
+
+        # only the bounding box of the part mask needs drawing
+        if self.part_bbox is not None:
+            y0, y1, x0, x1 = self.part_bbox
+            image = self._part_buffers.next(self.base_image.shape)
+            np.copyto(image, self.base_image)
+            image[y0:y1, x0:x1] = self.show_mask(
+                image[y0:y1, x0:x1], self.part_mask, self.labels[label]
+            )
+
+        return image
+
+    def render_part_preview(self, label, scale: float) -> np.ndarray:
+        """Draws the low resolution logits from `decode_part_mask` over a downscaled base image.
+
+        Nothing is upsampled or drawn at full resolution, so the preview is ready long before `render_part_image`.
+
+        Args:
+            label (str): label
+            scale (float): scale of the preview relative to the base image
+        """
+        assert label in self.labels
+
+        # the downscaled base image is kept for as long as the image is shown
+        if self._preview[0] != (self.filename, scale):
+            base = cv2.resize(
+                self.base_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+            )
+            self._preview = ((self.filename, scale), base)
+        base = self._preview[1]
+        if self._part_logits is None:
+            return base
+
+        # the logits cover the padded encoder input, only the part holding the image is resized
+        predictor = self.predictor
+        side = self._part_logits.shape[-1] / predictor.model.image_encoder.img_size
+        height, width = predictor.input_size
+        logits = self._part_logits[
+            0, 0, : math.ceil(height * side), : math.ceil(width * side)
+        ]
+        mask = (
+            cv2.resize(
+                logits.float().cpu().numpy(),
+                (base.shape[1], base.shape[0]),
+                interpolation=cv2.INTER_LINEAR,
+            )
+            > predictor.model.mask_threshold
+        )
+        return self.show_mask(base, mask, self.labels[label])
 
     def part_to_comp_mask(self, filename: str, key: str, add: bool = True):
         assert key in self.labels
 
-        # get the compound mask
-        if label_exists(
-            labeldir=self.labels_path,
-            image_filename=filename,
-            num_channels=self.num_labels,
-        ):
-            comp_mask = retrieve_label(
-                labeldir=self.labels_path,
-                image_filename=filename,
-            )
-        else:
-            comp_mask = np.zeros(
+        # nothing to merge
+        if self.part_bbox is None:
+            self.clear_coords_validity_part()
+            return
+
+        # get the compound mask, a new label has to be written in full
+        self._load_comp(filename)
+        is_new = self.comp_mask is None
+        channel = self.labels[key]
+        if is_new:
+            self._remember_edit(filename)
+            self.comp_mask = np.zeros(
                 (*self.base_image.shape[:2], self.num_labels), dtype=bool
             )
+        else:
+            self._remember_edit(filename, channel, self.part_bbox)
 
-        # save the mask
+        # merge the part mask only within its bounding box
+        y0, y1, x0, x1 = self.part_bbox
+        roi = self.comp_mask[y0:y1, x0:x1, channel]
         if add:
-            comp_mask[..., self.labels[key]] |= self.part_mask
+            roi |= self.part_mask
         else:
-            comp_mask[..., self.labels[key]] &= np.logical_not(self.part_mask)
-        save_label(
-            labeldir=self.labels_path,
-            image_filename=filename,
-            label=comp_mask,
-        )
+            roi &= np.logical_not(self.part_mask)
+
+        # only the touched channel needs to be written for existing labels
+        if is_new:
+            self.store.save(label_key(filename), self.comp_mask)
+        else:
+            self.store.save_channel(
+                label_key(filename), channel, self.comp_mask[..., channel]
+            )
+        self._redraw_comp(self.part_bbox)
 
         # reset the coords and validity
         self.clear_coords_validity_part()
 
+    def copy_comp_mask(self, filename: str, source_filename: str) -> bool:
+        """Uses the complete mask of another image as the starting label for this image.
+
+        Args:
+            filename (str): the image to write the label for
+            source_filename (str): the image to take the label from
+
+        Returns:
+            bool: whether the label was copied, masks with a different shape are not copied
+        """
+        comp_mask = self.store.retrieve(label_key(source_filename))
+        if comp_mask.shape[:2] != self.base_image.shape[:2]:
+            return False
+
+        self._remember_edit(filename)
+        self.store.save(label_key(filename), comp_mask)
+        self._invalidate_comp()
+
+        # reset the coords and validity
+        self.clear_coords_validity_part()
+        return True
+
+    def propagate(
+        self,
+        filename: str,
+        source_filename: str,
+        num_points: int = 1,
+        min_area: int = 64,
+        batch_size: int = 64,
+        overwrite: bool = False,
+    ) -> bool:
+        """Proposes a label for this image from the complete mask of another image.
+
+        Every connected component of every channel of the source label becomes one
+        box + interior points prompt, and all prompts are run through the mask decoder
+        in batches on the embeddings of the current image.
+        The embeddings must already be computed, ie: `reset` was called with this filename.
+
+        Args:
+            filename (str): the image to write the proposed label for
+            source_filename (str): the image to take the prompts from, usually the previous frame
+            num_points (int): number of interior points sampled per component
+            min_area (int): components smaller than this many pixels are ignored
+            batch_size (int): number of prompts per decoder pass
+            overwrite (bool): whether to replace a label that already exists for this image
+
+        Returns:
+            bool: whether a label was proposed
+        """
+        if not overwrite and self.store.exists(label_key(filename), self.num_labels):
+            return False
+
+        if not self.store.exists(label_key(source_filename), self.num_labels):
+            return False
+
+        source_mask = self.store.retrieve(label_key(source_filename))
+        if source_mask.shape[:2] != self.base_image.shape[:2]:
+            return False
+
+        # gather the prompts for all channels
+        channels, boxes, points = [], [], []
+        for i, mask in enumerate(np.moveaxis(source_mask, -1, 0)):
+            c_boxes, c_points = self.mask_to_prompts(
+                mask, num_points=num_points, min_area=min_area
+            )
+            channels += [i] * len(c_boxes)
+            boxes.append(c_boxes)
+            points.append(c_points)
+
+        if len(channels) == 0:
+            return False
+        channels = np.array(channels)
+        boxes = np.concatenate(boxes, axis=0)
+        points = np.concatenate(points, axis=0)
+
+        # run the decoder in batches
+        comp_mask = np.zeros((*self.base_image.shape[:2], self.num_labels), dtype=bool)
+        image_size = self.base_image.shape[:2]
+        device = self.predictor.device
+        for start in range(0, len(channels), batch_size):
+            end = start + batch_size
+            t_boxes = self.predictor.transform.apply_boxes_torch(
+                torch.as_tensor(boxes[start:end], dtype=torch.float, device=device),
+                image_size,
+            )
+            t_points = self.predictor.transform.apply_coords_torch(
+                torch.as_tensor(points[start:end], dtype=torch.float, device=device),
+                image_size,
+            )
+            t_labels = torch.ones(t_points.shape[:2], dtype=torch.int, device=device)
+            with self.inference.context():
+                masks, _, _ = self.predictor.predict_torch(
+                    point_coords=t_points,
+                    point_labels=t_labels,
+                    boxes=t_boxes,
+                    multimask_output=False,
+                )
+            masks = masks[:, 0].cpu().numpy()
+
+            for channel, mask in zip(channels[start:end], masks):
+                comp_mask[..., channel] |= mask
+
+        self._remember_edit(filename)
+        self.store.save(label_key(filename), comp_mask)
+        self._invalidate_comp()
+
+        # reset the coords and validity
+        self.clear_coords_validity_part()
+        return True
+
     def clear_comp_mask(self, filename: str, label: None | str = None):
-        if not label_exists(
-            labeldir=self.labels_path,
-            image_filename=filename,
-            num_channels=self.num_labels,
-        ):
+        if not self.store.exists(label_key(filename), self.num_labels):
             return
 
         # if full reset, delete the mask, otherwise, just override
         if label is None:
-            delete_label(
-                labeldir=self.labels_path,
-                image_filename=filename,
-            )
+            self._remember_edit(filename)
+            self.store.delete(label_key(filename))
+            self._invalidate_comp()
         else:
             assert label in self.labels
-            comp_mask = retrieve_label(
-                labeldir=self.labels_path,
-                image_filename=filename,
+            self._load_comp(filename)
+            channel = self.labels[label]
+            bbox = mask_bbox(self.comp_mask[..., channel])
+            if bbox is not None:
+                self._remember_edit(filename, channel, bbox)
+                self.comp_mask[..., channel] = False
+                self.store.save_channel(
+                    label_key(filename), channel, self.comp_mask[..., channel]
+                )
+                self._redraw_comp(bbox)
+
+        # reset the coords and validity
+        self.clear_coords_validity_part()
+
+    def _remember_edit(
+        self,
+        filename: str,
+        channel: None | int = None,
+        bbox: None | tuple[int, int, int, int] = None,
+    ):
+        """Keeps the part of a label that an edit is about to overwrite, so the edit can be undone.
+
+        Args:
+            filename (str): the image whose label is edited
+            channel (None | int): the channel being edited, or None if the whole label is replaced
+            bbox (None | tuple[int, int, int, int]): (y0, y1, x0, x1) of the edit within the channel
+        """
+        if channel is None:
+            previous = (
+                self.store.retrieve(label_key(filename))
+                if self.store.exists(label_key(filename), self.num_labels)
+                else None
             )
-            comp_mask[..., self.labels[label]] &= False
-            save_label(
-                labeldir=self.labels_path,
-                image_filename=filename,
-                label=comp_mask,
+        else:
+            y0, y1, x0, x1 = bbox
+            previous = self.comp_mask[y0:y1, x0:x1, channel].copy()
+
+        self.history.put(
+            next(self._history_ids),
+            {
+                "filename": filename,
+                "channel": channel,
+                "bbox": bbox,
+                "previous": previous,
+            },
+        )
+
+    def undo(self, filename: str) -> bool:
+        """Reverts the last edit to the label of an image.
+
+        The oldest edits are forgotten first when the memory budget runs out.
+
+        Args:
+            filename (str): the image to undo the last edit of
+
+        Returns:
+            bool: whether there was an edit to undo
+        """
+        for key in reversed(self.history.keys()):
+            entry = self.history.peek(key)
+            if entry is not None and entry["filename"] == filename:
+                self.history.pop(key)
+                break
+        else:
+            return False
+
+        if entry["channel"] is None:
+            if entry["previous"] is None:
+                self.store.delete(label_key(filename))
+            else:
+                self.store.save(label_key(filename), entry["previous"])
+            self._invalidate_comp()
+        else:
+            self._load_comp(filename)
+            if self.comp_mask is None:
+                return False
+            channel = entry["channel"]
+            y0, y1, x0, x1 = entry["bbox"]
+            self.comp_mask[y0:y1, x0:x1, channel] = entry["previous"]
+            self.store.save_channel(
+                label_key(filename), channel, self.comp_mask[..., channel]
             )
+            self._redraw_comp(entry["bbox"])
 
         # reset the coords and validity
         self.clear_coords_validity_part()
+        return True
+
+    @staticmethod
+    def mask_to_prompts(
+        mask: np.ndarray, num_points: int = 1, min_area: int = 64
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Derives one box and a set of interior points for every connected component of a mask.
+
+        The first point is always the pixel furthest from the component border,
+        the rest are sampled from the inner half of the component.
+
+        Args:
+            mask (np.ndarray): (H, W) array of booleans
+            num_points (int): number of interior points per component
+            min_area (int): components smaller than this many pixels are ignored
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: (N, 4) xyxy boxes and (N, num_points, 2) xy points
+        """
+        boxes = np.zeros((0, 4), dtype=np.float32)
+        points = np.zeros((0, num_points, 2), dtype=np.float32)
+        if not mask.any():
+            return boxes, points
+
+        mask = mask.astype(np.uint8)
+        num_components, components, stats, _ = cv2.connectedComponentsWithStats(
+            mask, connectivity=8
+        )
+        distance = cv2.distanceTransform(mask, cv2.DIST_L2, 3)
+        rng = np.random.default_rng(0)
+
+        boxes, points = [boxes], [points]
+        for i in range(1, num_components):
+            x, y, w, h, area = stats[i]
+            if area < min_area:
+                continue
+
+            # restrict everything to the bounding box of the component
+            c_distance = np.where(
+                components[y : y + h, x : x + w] == i,
+                distance[y : y + h, x : x + w],
+                0.0,
+            )
+            peak = np.unravel_index(np.argmax(c_distance), c_distance.shape)
+            c_points = [(peak[1], peak[0])]
+            if num_points > 1:
+                ys, xs = np.nonzero(c_distance >= c_distance[peak] / 2.0)
+                picks = rng.choice(len(xs), size=num_points - 1, replace=True)
+                c_points += list(zip(xs[picks], ys[picks]))
+
+            boxes.append(np.array([[x, y, x + w, y + h]], dtype=np.float32))
+            points.append(np.array([c_points], dtype=np.float32) + [x, y])
+
+        return np.concatenate(boxes, axis=0), np.concatenate(points, axis=0)
 
     @staticmethod
     def show_mask(image: np.ndarray, mask: np.ndarray, color_index=0):
         """show_mask.
 
         Args:
+            image (np.ndarray): (H, W, 3) uint8 image
             mask (np.ndarray): (H, W) array of booleans
-            ax (plt.Axes): ax
-            random_color:
+            color_index (int): index into the color palette
         """
 
         # ignore if all zeros
         if not mask.any():
             return image
 
-        color = colors[color_index]
-        image = image.astype(np.float32)
-        image[mask[...], :] *= 0.5
-        image[mask[...], :] += color * 0.5
-        image = np.clip(image, 0, 255).astype(np.uint8)
+        _, halves = palette(color_index + 1)
+        image = image.copy()
+        image[mask] = (image[mask] >> 1) + halves[color_index]
+        return image
+
+    @staticmethod
+    def show_masks(image: np.ndarray, masks: np.ndarray):
+        """Draws all channels of a label in one pass.
+
+        Where channels overlap, the highest channel is drawn.
+
+        Args:
+            image (np.ndarray): (H, W, 3) uint8 image
+            masks (np.ndarray): (H, W, C) array of booleans
+        """
+        covered = masks.any(axis=-1)
+        if not covered.any():
+            return image
+
+        # index of the last set channel of every covered pixel
+        indices = masks.shape[-1] - 1 - np.argmax(masks[covered][:, ::-1], axis=-1)
+
+        _, halves = palette(masks.shape[-1])
+        image = image.copy()
+        image[covered] = (image[covered] >> 1) + halves[indices]
         return image
@@ -0,0 +1,410 @@
+import argparse
+import collections
+import contextlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from typing import Iterator
+
+import numpy as np
+from PIL import Image
+
+# files with these extensions are opened as sqlite stores, anything else is a png directory
+SQLITE_EXTENSIONS = (".sqlite", ".sqlite3", ".db")
+
+# numpy dtypes of the png modes that labels are saved as
+_PNG_MODE_DTYPES = {"1": "bool", "L": "uint8", "I;16": "uint16", "I": "int32"}
+_PNG_CHANNEL = re.compile(r"^(.*)_(\d+)\.png$")
+
+
+def label_key(image_filename: str) -> str:
+    """The key a label is stored under, labels are shared by images with the same stem."""
+    return os.path.splitext(image_filename)[0]
+
+
+class LabelStore(ABC):
+    """LabelStore.
+
+    Interface for where labels live, a label is an array of [H, W, C] stored per image.
+    Labels are addressed by key, the stem of the image filename from `label_key`,
+    so callers holding a filename convert it once before calling the store.
+    """
+
+    @abstractmethod
+    def exists(self, key: str, num_channels: int) -> bool:
+        """Whether the label for a key exists with at least num_channels channels."""
+
+    @abstractmethod
+    def retrieve(self, key: str) -> np.ndarray:
+        """Returns the label for a key as an array of [H, W, C]."""
+
+    @abstractmethod
+    def save(self, key: str, label: np.ndarray) -> None:
+        """Saves the label for a key given an array of [H, W, C]."""
+
+    @abstractmethod
+    def save_channel(self, key: str, channel: int, layer: np.ndarray) -> None:
+        """Overwrites a single channel of a label that already exists."""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """Deletes the label for a key if it exists."""
+
+    @abstractmethod
+    def keys(self) -> Iterator[str]:
+        """Iterates over the keys of all stored labels."""
+
+    @abstractmethod
+    def channel_index(self) -> dict[str, list[int]]:
+        """Lists every stored channel of every label, including labels that are incomplete."""
+
+    @abstractmethod
+    def channel_info(self, key: str, channel: int) -> tuple[int, int, str]:
+        """Returns (height, width, dtype) of a stored channel without decoding it."""
+
+    @abstractmethod
+    def retrieve_channel(self, key: str, channel: int) -> np.ndarray:
+        """Returns a single channel of a label as an array of [H, W]."""
+
+    @abstractmethod
+    def delete_channel(self, key: str, channel: int) -> None:
+        """Deletes a single channel of a label if it exists."""
+
+    def mtime(self, key: str) -> None | float:
+        """Last modification time of a label, or None if the store doesn't track it."""
+        return None
+
+    def count(self) -> int:
+        """Number of stored labels."""
+        return sum(1 for _ in self.keys())
+
+    def items(self) -> Iterator[tuple[str, np.ndarray]]:
+        """Iterates over all stored labels as (key, label)."""
+        for key in self.keys():
+            yield key, self.retrieve(key)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Groups writes so they are applied together, stores without transactions apply them immediately."""
+        yield self
+
+    def close(self) -> None:
+        """Releases any resources held by the store."""
+
+
+class PNGDirStore(LabelStore):
+    """PNGDirStore.
+
+    Stores each channel of a label as `<stem>_{i}.png` in a directory.
+    """
+
+    def __init__(self, labeldir: str):
+        """__init__.
+
+        Args:
+            labeldir (str): directory of the labels on the disk
+        """
+        self.labeldir = labeldir
+
+    def _path(self, key: str, channel: int) -> str:
+        return os.path.join(self.labeldir, key + f"_{channel}.png")
+
+    def exists(self, key: str, num_channels: int) -> bool:
+        for i in range(num_channels):
+            if not os.path.isfile(self._path(key, i)):
+                return False
+        return True
+
+    def retrieve(self, key: str) -> np.ndarray:
+        npy_list = []
+        while True:
+            label_path = self._path(key, len(npy_list))
+            if not os.path.isfile(label_path):
+                assert len(npy_list) != 0
+                return np.stack(npy_list, axis=-1)
+
+            im = Image.open(label_path)
+            npy_list.append(np.array(im))
+
+    def save(self, key: str, label: np.ndarray) -> None:
+        assert len(label.shape) == 3
+        for i, layer in enumerate(np.transpose(label, (2, 0, 1))):
+            self.save_channel(key, i, layer)
+
+    def save_channel(self, key: str, channel: int, layer: np.ndarray) -> None:
+        assert len(layer.shape) == 2
+        im = Image.fromarray(layer)
+        im.save(self._path(key, channel))
+
+    def delete(self, key: str) -> None:
+        i = 0
+        while os.path.isfile(self._path(key, i)):
+            os.remove(self._path(key, i))
+            i += 1
+
+    def keys(self) -> Iterator[str]:
+        # every label has a zeroth channel
+        for filename in os.listdir(self.labeldir):
+            if filename.endswith("_0.png"):
+                yield filename[: -len("_0.png")]
+
+    def channel_index(self) -> dict[str, list[int]]:
+        index = collections.defaultdict(list)
+        for filename in os.listdir(self.labeldir):
+            match = _PNG_CHANNEL.match(filename)
+            if match is not None:
+                index[match.group(1)].append(int(match.group(2)))
+        return {key: sorted(channels) for key, channels in index.items()}
+
+    def channel_info(self, key: str, channel: int) -> tuple[int, int, str]:
+        # opening a png only parses the header
+        with Image.open(self._path(key, channel)) as im:
+            width, height = im.size
+            return height, width, _PNG_MODE_DTYPES.get(im.mode, im.mode)
+
+    def retrieve_channel(self, key: str, channel: int) -> np.ndarray:
+        with Image.open(self._path(key, channel)) as im:
+            return np.array(im)
+
+    def delete_channel(self, key: str, channel: int) -> None:
+        if os.path.isfile(self._path(key, channel)):
+            os.remove(self._path(key, channel))
+
+    def mtime(self, key: str) -> None | float:
+        mtimes = []
+        i = 0
+        while os.path.isfile(self._path(key, i)):
+            mtimes.append(os.path.getmtime(self._path(key, i)))
+            i += 1
+        return max(mtimes) if mtimes else None
+
+
+class SQLiteStore(LabelStore):
+    """SQLiteStore.
+
+    Stores all labels in a single sqlite file, one zlib compressed row per channel.
+    Boolean channels are bit packed before compression. Each row keeps the time it was written,
+    so incremental checks can skip unchanged labels.
+    """
+
+    def __init__(self, path: str, compression: int = 6):
+        """__init__.
+
+        Args:
+            path (str): path to the sqlite file, created if it doesn't exist
+            compression (int): zlib compression level
+        """
+        self.path = path
+        self.compression = compression
+
+        # the store is shared between the ui and the inference thread
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS labels (
+                key TEXT NOT NULL,
+                channel INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                width INTEGER NOT NULL,
+                dtype TEXT NOT NULL,
+                data BLOB NOT NULL,
+                mtime REAL,
+                PRIMARY KEY (key, channel)
+            )""")
+
+        # stores written before rows kept their write time have no mtime column
+        columns = [
+            row[1] for row in self._connection.execute("PRAGMA table_info(labels)")
+        ]
+        if "mtime" not in columns:
+            self._connection.execute("ALTER TABLE labels ADD COLUMN mtime REAL")
+        self._connection.commit()
+        self._depth = 0
+
+    def _encode(self, layer: np.ndarray) -> bytes:
+        data = np.packbits(layer) if layer.dtype == bool else layer
+        return zlib.compress(np.ascontiguousarray(data).tobytes(), self.compression)
+
+    @staticmethod
+    def _decode(height: int, width: int, dtype: str, data: bytes) -> np.ndarray:
+        raw = zlib.decompress(data)
+        if dtype == "bool":
+            bits = np.unpackbits(
+                np.frombuffer(raw, dtype=np.uint8), count=height * width
+            )
+            return bits.astype(bool).reshape(height, width)
+        return np.frombuffer(raw, dtype=dtype).reshape(height, width).copy()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                if self._depth == 1:
+                    self._connection.rollback()
+                raise
+            else:
+                if self._depth == 1:
+                    self._connection.commit()
+            finally:
+                self._depth -= 1
+
+    def exists(self, key: str, num_channels: int) -> bool:
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM labels WHERE key = ? AND channel < ?",
+                (key, num_channels),
+            ).fetchone()
+        return count == num_channels
+
+    def retrieve(self, key: str) -> np.ndarray:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT height, width, dtype, data FROM labels WHERE key = ? ORDER BY channel",
+                (key,),
+            ).fetchall()
+        assert len(rows) != 0
+        return np.stack([self._decode(*row) for row in rows], axis=-1)
+
+    def save(self, key: str, label: np.ndarray) -> None:
+        assert len(label.shape) == 3
+        with self.transaction():
+            # drop stale channels in case the label shrank
+            self._connection.execute(
+                "DELETE FROM labels WHERE key = ? AND channel >= ?",
+                (key, label.shape[-1]),
+            )
+            for i, layer in enumerate(np.transpose(label, (2, 0, 1))):
+                self.save_channel(key, i, layer)
+
+    def save_channel(self, key: str, channel: int, layer: np.ndarray) -> None:
+        assert len(layer.shape) == 2
+        with self.transaction():
+            self._connection.execute(
+                "INSERT OR REPLACE INTO labels (key, channel, height, width, dtype, data, mtime) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    channel,
+                    layer.shape[0],
+                    layer.shape[1],
+                    layer.dtype.name,
+                    self._encode(layer),
+                    time.time(),
+                ),
+            )
+
+    def delete(self, key: str) -> None:
+        with self.transaction():
+            self._connection.execute("DELETE FROM labels WHERE key = ?", (key,))
+
+    def keys(self) -> Iterator[str]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key FROM labels WHERE channel = 0"
+            ).fetchall()
+        for (key,) in rows:
+            yield key
+
+    def channel_index(self) -> dict[str, list[int]]:
+        index = collections.defaultdict(list)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key, channel FROM labels ORDER BY key, channel"
+            ).fetchall()
+        for key, channel in rows:
+            index[key].append(channel)
+        return dict(index)
+
+    def channel_info(self, key: str, channel: int) -> tuple[int, int, str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT height, width, dtype FROM labels WHERE key = ? AND channel = ?",
+                (key, channel),
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"No channel {channel} for {key}.")
+        return row
+
+    def retrieve_channel(self, key: str, channel: int) -> np.ndarray:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT height, width, dtype, data FROM labels WHERE key = ? AND channel = ?",
+                (key, channel),
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"No channel {channel} for {key}.")
+        return self._decode(*row)
+
+    def delete_channel(self, key: str, channel: int) -> None:
+        with self.transaction():
+            self._connection.execute(
+                "DELETE FROM labels WHERE key = ? AND channel = ?",
+                (key, channel),
+            )
+
+    def mtime(self, key: str) -> None | float:
+        # rows from before the mtime column have none, they are not tracked
+        with self._lock:
+            (mtime,) = self._connection.execute(
+                "SELECT MAX(mtime) FROM labels WHERE key = ?", (key,)
+            ).fetchone()
+        return mtime
+
+    def count(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM labels WHERE channel = 0"
+            ).fetchone()
+        return count
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+_stores: dict[str, LabelStore] = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(location: str) -> LabelStore:
+    """Opens the label store at a location, stores are cached so repeated calls are cheap.
+
+    Args:
+        location (str): a directory for png labels, or a `.sqlite`/`.db` file for a sqlite store
+
+    Returns:
+        LabelStore:
+    """
+    location = os.path.abspath(location)
+    with _stores_lock:
+        if location not in _stores:
+            if location.endswith(SQLITE_EXTENSIONS):
+                _stores[location] = SQLiteStore(location)
+            else:
+                _stores[location] = PNGDirStore(location)
+        return _stores[location]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="SAMTool Convert Labels",
+        description="Copies all labels from one label store to another, eg: from a png directory to a sqlite file.",
+    )
+    parser.add_argument("--source", required=True)
+    parser.add_argument("--dest", required=True)
+    args = parser.parse_args()
+
+    source, dest = open_store(args.source), open_store(args.dest)
+    copied = 0
+    with dest.transaction():
+        for key, label in source.items():
+            dest.save(key, label)
+            copied += 1
+    print(f"Copied {copied} labels from {args.source} to {args.dest}.")
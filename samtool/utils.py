@@ -1,81 +1,92 @@
-import os
-
 import numpy as np
-from PIL import Image
+
+from samtool.storage import label_key, open_store
 
 
 def label_exists(labeldir: str, image_filename: str, num_channels: int) -> bool:
     """Tests whether the label exists for a given image.
 
     Args:
-        labeldir (str): directory of the labels on the disk
+        labeldir (str): directory of the labels on the disk, or a sqlite label store
         image_filename (str): name of the image that corresponds to this label
         num_channels (int): number of channels that is expected
 
     Returns:
         bool:
     """
-    for i in range(num_channels):
-        label_filename = os.path.splitext(image_filename)[0] + f"_{i}.png"
-        if not os.path.isfile(os.path.join(labeldir, label_filename)):
-            return False
-    return True
+    return open_store(labeldir).exists(label_key(image_filename), num_channels)
 
 
 def delete_label(labeldir: str, image_filename: str) -> None:
     """Deletes the label for a specific image if it exists
 
     Args:
-        labeldir (str): directory of the labels on the disk
+        labeldir (str): directory of the labels on the disk, or a sqlite label store
         image_filename (str): name of the image that corresponds to this label
 
     Returns:
         None:
     """
-    i = -1
-    while True:
-        i += 1
-        label_filename = os.path.splitext(image_filename)[0] + f"_{i}.png"
-        if not os.path.isfile(os.path.join(labeldir, label_filename)):
-            return
-
-        os.remove(os.path.join(labeldir, label_filename))
+    open_store(labeldir).delete(label_key(image_filename))
 
 
 def save_label(labeldir: str, image_filename: str, label: np.ndarray) -> None:
-    """Saves the label to a series of png images on the disk given a npy array.
+    """Saves the label to the label store given a npy array.
 
     Args:
-        labeldir (str): directory of the labels on the disk
+        labeldir (str): directory of the labels on the disk, or a sqlite label store
         image_filename (str): name of the image that corresponds to this label
         label (np.ndarray): an array of [W, H, C]
 
     Returns:
         None:
     """
-    assert len(label.shape) == 3
-    for i, layer in enumerate(np.transpose(label, (2, 0, 1))):
-        label_filename = os.path.splitext(image_filename)[0] + f"_{i}.png"
-        im = Image.fromarray(layer)
-        im.save(os.path.join(labeldir, label_filename))
+    open_store(labeldir).save(label_key(image_filename), label)
+
+
+def save_label_channel(
+    labeldir: str, image_filename: str, channel: int, layer: np.ndarray
+) -> None:
+    """Saves a single channel of a label that already exists on the disk.
+
+    Args:
+        labeldir (str): directory of the labels on the disk, or a sqlite label store
+        image_filename (str): name of the image that corresponds to this label
+        channel (int): index of the channel to overwrite
+        layer (np.ndarray): an array of [W, H]
+
+    Returns:
+        None:
+    """
+    open_store(labeldir).save_channel(label_key(image_filename), channel, layer)
 
 
 def retrieve_label(labeldir: str, image_filename: str) -> np.ndarray:
     """retrieve_label.
 
     Args:
-        labeldir (str): directory of the labels on the disk
+        labeldir (str): directory of the labels on the disk, or a sqlite label store
         image_filename (str): name of the image that corresponds to this label
 
     Returns:
         np.ndarray: the label as an array of [W, H, C]
     """
-    npy_list = []
-    while True:
-        label_filename = os.path.splitext(image_filename)[0] + f"_{len(npy_list)}.png"
-        if not os.path.isfile(os.path.join(labeldir, label_filename)):
-            assert len(npy_list) != 0
-            return np.stack(npy_list, axis=-1)
-
-        im = Image.open(os.path.join(labeldir, label_filename))
-        npy_list.append(np.array(im))
+    return open_store(labeldir).retrieve(label_key(image_filename))
+
+
+def mask_bbox(mask: np.ndarray) -> None | tuple[int, int, int, int]:
+    """Finds the bounding box of a mask.
+
+    Args:
+        mask (np.ndarray): an array of [H, W] booleans
+
+    Returns:
+        None | tuple[int, int, int, int]: (y0, y1, x0, x1) with exclusive ends, or None if the mask is empty
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+
+    # only the rows that have something in them need to be scanned for columns
+    cols = np.flatnonzero(mask[rows[0] : rows[-1] + 1].any(axis=0))
+    return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
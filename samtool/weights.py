@@ -0,0 +1,93 @@
+import argparse
+import hashlib
+import os
+import urllib.error
+import urllib.request
+
+SAM_VIT_L_URL = "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_l_0b3195.pth"
+
+# weights are kept beside the package unless told otherwise
+DEFAULT_CACHE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def file_md5(path: str, chunk_size: int = 1 << 20) -> str:
+    """Computes the md5 hex digest of a file without reading it into memory at once."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def fetch_checkpoint(
+    url: str = SAM_VIT_L_URL,
+    cache_dir: None | str = None,
+    md5: None | str = None,
+    chunk_size: int = 1 << 20,
+) -> str:
+    """Downloads a checkpoint into the cache unless it is already there.
+
+    Partial downloads are kept as `.part` files and resumed with a range request on the next call.
+    The download is verified against an md5 digest before being moved into place,
+    the SAM checkpoint filenames carry the leading digits of their md5 so those are used by default.
+
+    Args:
+        url (str): where to download the checkpoint from
+        cache_dir (None | str): directory to keep the checkpoint in
+        md5 (None | str): expected md5 digest, or a prefix of it
+        chunk_size (int): number of bytes read at a time
+
+    Returns:
+        str: path to the checkpoint
+    """
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    filename = os.path.basename(url)
+    path = os.path.join(cache_dir, filename)
+    if os.path.isfile(path):
+        return path
+
+    if md5 is None:
+        md5 = os.path.splitext(filename)[0].rsplit("_", 1)[-1]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    partial_path = path + ".part"
+    start = os.path.getsize(partial_path) if os.path.isfile(partial_path) else 0
+
+    print(f"Model weights not found, downloading them from `{url}`...")
+    request = urllib.request.Request(url)
+    if start > 0:
+        request.add_header("Range", f"bytes={start}-")
+
+    try:
+        with urllib.request.urlopen(request) as response:
+            # the server may ignore the range and send everything
+            if start > 0 and response.status != 206:
+                start = 0
+            total = start + int(response.headers.get("Content-Length", 0))
+
+            with open(partial_path, "ab" if start > 0 else "wb") as f:
+                done = start
+                while chunk := response.read(chunk_size):
+                    f.write(chunk)
+                    done += len(chunk)
+                    if total > 0:
+                        print(f"\r{done / total * 100:.1f}%", end="", flush=True)
+            print()
+    except urllib.error.HTTPError as e:
+        # the partial download is already complete
+        if e.code != 416:
+            raise
+
+    if not file_md5(partial_path).startswith(md5):
+        os.remove(partial_path)
+        raise RuntimeError(f"Checksum mismatch for {url}, the download was discarded.")
+
+    os.replace(partial_path, path)
+    return path
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Adds the checkpoint options to a command line parser."""
+    group = parser.add_argument_group("checkpoint")
+    group.add_argument("--checkpoint", default=None)
+    group.add_argument("--cache-dir", default=None)
@@ -0,0 +1,78 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+# returned in place of a result when a newer request has superseded this one
+STALE = object()
+
+
+class InferenceWorker:
+    """InferenceWorker.
+
+    Runs all SAM work on one dedicated thread so async handlers never block the event loop.
+    Since there is only one thread, jobs run in the order they are submitted
+    and the model and label state are never touched concurrently.
+    """
+
+    def __init__(self):
+        """__init__."""
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="samtool-inference"
+        )
+        self._tickets: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Runs a function on the inference thread and waits for the result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    def offload(self, fn: Callable) -> Callable:
+        """Wraps a blocking function into an async function that runs on the inference thread."""
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await self.run(fn, *args, **kwargs)
+
+        return wrapper
+
+    def ticket(self, key: str) -> int:
+        """Takes a new ticket for a key, which supersedes all previous tickets for that key."""
+        with self._lock:
+            self._tickets[key] = self._tickets.get(key, 0) + 1
+            return self._tickets[key]
+
+    def is_latest(self, key: str, ticket: int) -> bool:
+        """Whether no newer ticket has been taken for this key."""
+        with self._lock:
+            return self._tickets.get(key, 0) == ticket
+
+    async def run_if_latest(
+        self, key: str, ticket: int, fn: Callable, *args, **kwargs
+    ) -> Any:
+        """Runs a function on the inference thread unless the ticket is superseded.
+
+        The ticket is checked once the job reaches the front of the queue and again once it completes,
+        so rapid requests coalesce into the most recent one instead of piling up.
+
+        Returns:
+            Any: the result of the function, or `STALE` if a newer ticket exists
+        """
+
+        def job():
+            if not self.is_latest(key, ticket):
+                return STALE
+            return fn(*args, **kwargs)
+
+        result = await self.run(job)
+        if not self.is_latest(key, ticket):
+            return STALE
+        return result
+
+    def shutdown(self) -> None:
+        """Stops the inference thread once pending jobs are done."""
+        self._executor.shutdown(wait=True)
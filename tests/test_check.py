@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import samtool.check
+from samtool.check import check_labels
+from samtool.storage import open_store
+
+
+@pytest.fixture(params=["png", "sqlite"])
+def dirs(request, tmp_path):
+    imagedir = tmp_path / "images"
+    imagedir.mkdir()
+    for name in ("img.jpg", "img.v2.jpg", "other.png"):
+        Image.new("RGB", (16, 12)).save(imagedir / name)
+
+    if request.param == "png":
+        labeldir = tmp_path / "labels"
+        labeldir.mkdir()
+    else:
+        labeldir = tmp_path / "labels.db"
+    return str(imagedir), str(labeldir)
+
+
+def kinds(issues: list[dict]) -> list[tuple[str, str, bool]]:
+    return sorted((i["key"], i["kind"], i["fixed"]) for i in issues)
+
+
+def test_fix_with_dotted_stems(dirs):
+    imagedir, labeldir = dirs
+    store = open_store(labeldir)
+
+    full = np.zeros((12, 16, 3), dtype=bool)
+    full[2:6, 3:8, 2] = True
+    store.save("img", full)
+
+    # img.v2 is missing channel 2, other has a stale channel 3 and a uint8 channel
+    store.save("img.v2", np.zeros((12, 16, 2), dtype=bool))
+    store.save("other", np.zeros((12, 16, 4), dtype=bool))
+    store.save_channel("other", 1, np.full((12, 16), 7, dtype=np.uint8))
+
+    issues = check_labels(imagedir, labeldir, 3)
+    assert kinds(issues) == [
+        ("img.v2", "incomplete", False),
+        ("other", "dtype", False),
+        ("other", "stale", False),
+    ]
+
+    issues = check_labels(imagedir, labeldir, 3, fix=True)
+    assert all(i["fixed"] for i in issues)
+
+    # the fixes only touched the labels they were meant for
+    np.testing.assert_array_equal(store.retrieve("img"), full)
+    assert store.channel_index() == {
+        "img": [0, 1, 2],
+        "img.v2": [0, 1, 2],
+        "other": [0, 1, 2],
+    }
+    assert store.retrieve("other")[..., 1].all()
+    assert check_labels(imagedir, labeldir, 3) == []
+
+
+def test_reports_shape_and_orphans(dirs):
+    imagedir, labeldir = dirs
+    store = open_store(labeldir)
+    store.save("img", np.zeros((10, 16, 3), dtype=bool))
+    store.save("gone.v1", np.zeros((12, 16, 3), dtype=bool))
+
+    issues = check_labels(imagedir, labeldir, 3, fix=True)
+    assert ("gone.v1", "orphan", False) in kinds(issues)
+    assert {i["kind"] for i in issues if i["key"] == "img"} == {"shape"}
+    assert not any(i["fixed"] for i in issues)
+
+
+def test_incremental_checks(dirs, tmp_path, monkeypatch):
+    imagedir, labeldir = dirs
+    state_path = str(tmp_path / "check.json")
+    store = open_store(labeldir)
+    store.save("img", np.zeros((12, 16, 2), dtype=bool))
+    store.save("img.v2", np.zeros((12, 16, 2), dtype=bool))
+    assert check_labels(imagedir, labeldir, 2, state_path=state_path) == []
+
+    checked = []
+    check_label = samtool.check.check_label
+    monkeypatch.setattr(
+        samtool.check,
+        "check_label",
+        lambda store, key, *args, **kwargs: checked.append(key)
+        or check_label(store, key, *args, **kwargs),
+    )
+
+    # unchanged labels are skipped, on both backends
+    assert check_labels(imagedir, labeldir, 2, state_path=state_path) == []
+    assert checked == []
+
+    # a deleted channel is noticed even though the other channel didn't change
+    store.delete_channel("img.v2", 1)
+    issues = check_labels(imagedir, labeldir, 2, state_path=state_path)
+    assert checked == ["img.v2"]
+    assert kinds(issues) == [("img.v2", "incomplete", False)]
+
+
+def test_annotation_changes_invalidate_the_state(dirs, tmp_path):
+    imagedir, labeldir = dirs
+    state_path = str(tmp_path / "check.json")
+    open_store(labeldir).save("img", np.zeros((12, 16, 2), dtype=bool))
+    assert check_labels(imagedir, labeldir, 2, state_path=state_path) == []
+
+    # a third class was added to the annotations
+    issues = check_labels(imagedir, labeldir, 3, state_path=state_path)
+    assert kinds(issues) == [("img", "incomplete", False)]
@@ -0,0 +1,35 @@
+import numpy as np
+
+from samtool.colors import _linear_srgb_to_oklab, _to_linear, generate_colors, palette
+
+
+def oklab_distances(colors: np.ndarray) -> np.ndarray:
+    lab = _linear_srgb_to_oklab(_to_linear(colors / 255.0))
+    distances = np.linalg.norm(lab[:, None] - lab[None], axis=-1)
+    np.fill_diagonal(distances, np.inf)
+    return distances
+
+
+def test_no_duplicates_in_large_palettes():
+    colors = generate_colors(4096)
+    assert colors.shape == (4096, 3) and colors.dtype == np.uint8
+    assert len(np.unique(colors, axis=0)) == len(colors)
+
+
+def test_colors_are_perceptually_apart():
+    distances = oklab_distances(generate_colors(256))
+
+    # about 0.02 in oklab is barely visible, the first few labels should be far apart
+    assert distances[:16, :16].min() > 0.1
+    assert distances[:64, :64].min() > 0.05
+    assert distances.min() > 0.025
+
+
+def test_palette_grows_without_changing_colors():
+    colors, halves = palette(10)
+    first = colors[:10].copy()
+
+    colors, halves = palette(1000)
+    assert len(colors) >= 1000
+    np.testing.assert_array_equal(colors[:10], first)
+    np.testing.assert_array_equal(halves, colors >> 1)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("cv2")
+
+from samtool.dedup import (  # noqa: E402
+    DuplicateIndex,
+    compute_hashes,
+    hamming_distance,
+    image_hash,
+)
+
+
+def chain(num_frames: int, step: int) -> np.ndarray:
+    """Hashes that each differ from the previous one by step more bits, like a slow pan."""
+    bits = np.zeros((num_frames, 64), dtype=bool)
+    for i in range(1, num_frames):
+        bits[i] = bits[i - 1]
+        bits[i, (i - 1) * step : i * step] = True
+    return np.packbits(bits, axis=-1)
+
+
+def test_hamming_distance():
+    hashes = np.array([[0b0000_0000], [0b1111_0000], [0b1111_1111]], dtype=np.uint8)
+    np.testing.assert_array_equal(hamming_distance(hashes, hashes[0]), [0, 4, 8])
+    assert hamming_distance(hashes, hashes[:2]).shape == (2, 3)
+
+
+def test_slow_pan_is_not_one_group():
+    filenames = [f"{i:02d}.jpg" for i in range(20)]
+    hashes = chain(20, step=2)
+    index = DuplicateIndex(filenames, hashes, threshold=4)
+
+    # every image is within the threshold of its representative
+    for filename in filenames:
+        distance = hamming_distance(
+            hashes[filenames.index(index.representative(filename))][None],
+            hashes[filenames.index(filename)],
+        )
+        assert distance[0] <= 4
+
+    # each leader takes the two frames after it
+    assert [g[0] for g in index.groups()] == filenames[::3]
+    assert not index.is_redundant("00.jpg") and not index.is_redundant("03.jpg")
+    assert index.is_redundant("01.jpg") and index.is_redundant("02.jpg")
+    assert sum(index.is_redundant(f) for f in filenames) == 13
+
+
+def test_neighbours_nearest_first():
+    filenames = [f"{i:02d}.jpg" for i in range(5)]
+    index = DuplicateIndex(filenames, chain(5, step=1), threshold=2)
+    assert index.neighbours("02.jpg") == ["01.jpg", "03.jpg", "00.jpg", "04.jpg"]
+    assert index.neighbours("00.jpg") == ["01.jpg", "02.jpg"]
+    assert not index.is_redundant("unknown.jpg")
+
+
+def test_hashes_and_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (64, 80), dtype=np.uint8)
+    Image.fromarray(noise).save(tmp_path / "a.png")
+    Image.fromarray(noise).save(tmp_path / "copy.png")
+    Image.fromarray(255 - noise).save(tmp_path / "inverted.png")
+
+    assert image_hash(str(tmp_path / "a.png")).shape == (8,)
+    with pytest.raises(ValueError):
+        image_hash(str(tmp_path / "missing.png"))
+
+    index = DuplicateIndex.build(str(tmp_path), threshold=4, num_workers=2)
+    assert index.filenames == ["a.png", "copy.png", "inverted.png"]
+    assert index.groups() == [["a.png", "copy.png"]]
+    np.testing.assert_array_equal(
+        compute_hashes(str(tmp_path), ["copy.png"]), index.hashes[1:2]
+    )
+
+    index.save(str(tmp_path / "index.npz"))
+    loaded = DuplicateIndex.load(str(tmp_path / "index.npz"))
+    assert loaded.filenames == index.filenames and loaded.threshold == 4
+    assert loaded.representative("copy.png") == "a.png"
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from samtool.export import export_labels, to_index_map
+from samtool.storage import open_store
+
+
+def test_to_index_map_conflicts():
+    label = np.zeros((4, 4, 3), dtype=bool)
+    label[0, :, 1] = True
+    label[:, 0, 2] = True
+    index, conflicts = to_index_map(label)
+    assert index[0, 1] == 1 and index[1, 0] == 2
+    assert conflicts[0, 0] and index[0, 0] == 0
+
+
+@pytest.mark.parametrize("backend", ["png", "sqlite"])
+def test_export_with_dotted_stems(backend, tmp_path):
+    labeldir = str(tmp_path / ("labels.db" if backend == "sqlite" else "labels"))
+    if backend == "png":
+        (tmp_path / "labels").mkdir()
+
+    store = open_store(labeldir)
+    for key, channel in (("frame.v1", 1), ("frame.v2", 2)):
+        label = np.zeros((8, 8, 3), dtype=bool)
+        label[2:4, 2:4, channel] = True
+        store.save(key, label)
+
+    outdir = tmp_path / "out"
+    report = export_labels(
+        labeldir, ["__ignore__", "cat", "dog"], outdir=str(outdir), num_workers=2
+    )
+    assert report["images"] == 2
+    assert report["pixels"][1:] == [4, 4]
+    assert report["instances"][1:] == [1, 1]
+    assert np.array(Image.open(outdir / "frame.v2.png"))[2, 2] == 2
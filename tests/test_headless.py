@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("cv2")
+pytest.importorskip("segment_anything")
+
+from samtool import headless  # noqa: E402
+from samtool.inference import InferenceConfig  # noqa: E402
+
+
+class FakePredictor:
+    """Predicts the whole image as foreground if the image it was set with is bright."""
+
+    device = "cpu"
+
+    def __init__(self):
+        self.encoded = 0
+        self.reset_image()
+
+    def reset_image(self):
+        self.features = None
+        self.original_size = None
+        self.input_size = None
+        self.is_image_set = False
+
+    def set_image(self, image):
+        self.encoded += 1
+        self.features = torch.tensor([float(image.mean() > 127)])
+        self.original_size = image.shape[:2]
+        self.input_size = image.shape[:2]
+        self.is_image_set = True
+
+    def predict(self, point_coords, point_labels, box, multimask_output):
+        mask = np.full((1, *self.original_size), bool(self.features.item()))
+        return mask, np.ones(1), None
+
+
+@pytest.fixture
+def predictor(monkeypatch):
+    predictor = FakePredictor()
+    monkeypatch.setattr(
+        headless,
+        "shared_predictor",
+        lambda inference, **kwargs: (inference or InferenceConfig(), predictor),
+    )
+    return predictor
+
+
+def test_interleaved_sessions_predict_on_their_own_image(predictor):
+    bright = np.full((8, 8, 3), 255, dtype=np.uint8)
+    dark = np.zeros((6, 10, 3), dtype=np.uint8)
+    point = np.array([[1.0, 1.0]])
+
+    a = headless.Session(bright, labels={"thing": 0})
+    b = headless.Session(dark, labels={"thing": 0})
+
+    # b set its image last, yet a still decodes against its own embeddings
+    masks = a.predict(points=point, batch=False)
+    assert masks.shape == (1, 8, 8) and masks.all()
+    assert a.commit("thing", save=False)[..., 0].all()
+
+    masks = b.predict(points=point, batch=False)
+    assert masks.shape == (1, 6, 10) and not masks.any()
+
+    # switching back and forth never runs the encoder again
+    assert predictor.encoded == 2
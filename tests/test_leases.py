@@ -0,0 +1,85 @@
+import logging
+import time
+
+import pytest
+
+from samtool.leases import Lease, MemoryCoordinator, open_coordinator
+
+IMAGES = [f"{i}.png" for i in range(10)]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def coordinator(request, tmp_path):
+    if request.param == "memory":
+        return MemoryCoordinator()
+    return open_coordinator(str(tmp_path / "leases.db"))
+
+
+def test_batches_are_exclusive(coordinator):
+    a = coordinator.acquire("a", IMAGES, 3, ttl=60.0)
+    b = coordinator.acquire("b", IMAGES, 3, ttl=60.0)
+    assert a == IMAGES[:3]
+    assert b == IMAGES[3:6]
+    assert sorted(coordinator.held("a")) == sorted(a)
+
+
+def test_expired_leases_are_taken_over(coordinator):
+    coordinator.acquire("a", IMAGES, 2, ttl=0.05)
+    time.sleep(0.1)
+
+    # nobody took them yet, so a renewal revives them
+    assert sorted(coordinator.held("a")) == IMAGES[:2]
+    coordinator.renew("a", ttl=0.05)
+    assert coordinator.acquire("b", IMAGES[:2], 2, ttl=60.0) == []
+
+    time.sleep(0.1)
+    assert coordinator.acquire("b", IMAGES[:2], 2, ttl=60.0) == IMAGES[:2]
+    assert coordinator.held("a") == []
+    coordinator.renew("a", ttl=60.0)
+    assert coordinator.held("a") == []
+
+
+def test_complete_only_marks_owned_images(coordinator):
+    coordinator.acquire("a", IMAGES, 2, ttl=60.0)
+    assert coordinator.complete("b", IMAGES[:2]) == []
+    assert coordinator.complete("a", IMAGES[:2]) == IMAGES[:2]
+
+    # completed images are never handed out again, even after a release
+    coordinator.release("a")
+    assert coordinator.acquire("b", IMAGES, 2, ttl=60.0) == IMAGES[2:4]
+
+
+def test_lease_drops_lost_images(coordinator):
+    lease = Lease(coordinator, owner="a", batch_size=3, ttl=0.05)
+    lease._stop.set()
+    images = lease.images
+    lease.extend(IMAGES)
+    lease.complete(IMAGES[:1])
+    time.sleep(0.1)
+
+    # another instance takes over the expired, uncompleted images
+    assert coordinator.acquire("b", IMAGES, 1, ttl=60.0) == [IMAGES[1]]
+    assert lease.refresh() == [IMAGES[1]]
+    assert images == [IMAGES[0], IMAGES[2]]
+    assert lease.holds(IMAGES[0]) and lease.holds(IMAGES[2])
+    assert not lease.holds(IMAGES[1])
+
+
+def test_heartbeat_survives_errors(caplog):
+    class Flaky(MemoryCoordinator):
+        calls = 0
+
+        def renew(self, owner, ttl):
+            Flaky.calls += 1
+            if Flaky.calls == 1:
+                raise OSError("stale file handle")
+            super().renew(owner, ttl)
+
+    coordinator = Flaky()
+    with caplog.at_level(logging.ERROR, logger="samtool.leases"):
+        lease = Lease(coordinator, owner="a", ttl=0.06)
+        time.sleep(0.15)
+        lease.close()
+
+    assert Flaky.calls >= 2
+    assert "Failed to renew" in caplog.text
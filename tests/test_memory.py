@@ -0,0 +1,40 @@
+import numpy as np
+
+from samtool.memory import LRUCache, MemoryBudget, RenderBuffers
+
+
+def test_budget_evicts_the_largest_cache_first():
+    budget = MemoryBudget(total=300)
+    images = LRUCache("images", budget=budget)
+    undo = LRUCache("undo", budget=budget)
+
+    undo.put(0, np.zeros(50, dtype=np.uint8))
+    for i in range(3):
+        images.put(i, np.zeros(100, dtype=np.uint8))
+
+    assert images.keys() == [1, 2]
+    assert undo.keys() == [0]
+    assert sum(budget.usage().values()) <= 300
+
+
+def test_newest_entry_is_kept_over_budget():
+    budget = MemoryBudget(total=10)
+    cache = LRUCache("images", budget=budget)
+    cache.put("a", np.zeros(100, dtype=np.uint8))
+    cache.put("b", np.zeros(100, dtype=np.uint8))
+    assert cache.keys() == ["b"]
+    assert cache.nbytes == 100
+
+
+def test_render_buffers_are_not_reused_while_in_flight():
+    buffers = RenderBuffers(count=5)
+    shape = (4, 4, 3)
+    in_flight = [buffers.next(shape) for _ in range(4)]
+
+    # the next buffer is none of the last count - 1 renders
+    following = buffers.next(shape)
+    assert all(following is not b for b in in_flight)
+
+    # and the ring reuses its memory after that
+    assert buffers.next(shape) is in_flight[0]
+    assert buffers.nbytes == 5 * 4 * 4 * 3
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from samtool.storage import PNGDirStore, SQLiteStore, label_key, open_store
+from samtool.utils import label_exists, retrieve_label, save_label
+
+
+@pytest.fixture(params=["png", "sqlite"])
+def labeldir(request, tmp_path):
+    if request.param == "png":
+        return str(tmp_path)
+    return str(tmp_path / "labels.db")
+
+
+def make_label(seed: int, num_channels: int = 3) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.random((12, 16, num_channels)) > 0.5
+
+
+def test_label_key_keeps_inner_dots():
+    assert label_key("frame.v2.jpg") == "frame.v2"
+    assert label_key("frame.jpg") == "frame"
+
+
+def test_open_store_picks_backend(labeldir):
+    store = open_store(labeldir)
+    expected = SQLiteStore if labeldir.endswith(".db") else PNGDirStore
+    assert isinstance(store, expected)
+
+
+def test_round_trip_with_dotted_stems(labeldir):
+    store = open_store(labeldir)
+    labels = {"img": make_label(0), "img.v2": make_label(1), "a.b.c": make_label(2)}
+    for key, label in labels.items():
+        store.save(key, label)
+
+    assert sorted(store.keys()) == sorted(labels)
+    assert store.count() == len(labels)
+    for key, label in store.items():
+        np.testing.assert_array_equal(label, labels[key])
+
+    # keys from the store are accepted back as they are
+    for key in store.keys():
+        assert store.exists(key, 3)
+        np.testing.assert_array_equal(store.retrieve(key), labels[key])
+
+
+def test_channel_methods_address_the_right_label(labeldir):
+    store = open_store(labeldir)
+    store.save("img", make_label(0))
+    store.save("img.v2", make_label(1))
+
+    store.delete_channel("img.v2", 2)
+    assert store.channel_index() == {"img": [0, 1, 2], "img.v2": [0, 1]}
+    assert store.channel_info("img", 2) == (12, 16, "bool")
+    np.testing.assert_array_equal(
+        store.retrieve_channel("img", 2), make_label(0)[..., 2]
+    )
+
+    store.save_channel("img.v2", 2, np.zeros((12, 16), dtype=bool))
+    np.testing.assert_array_equal(store.retrieve("img"), make_label(0))
+    assert not store.retrieve("img.v2")[..., 2].any()
+
+    store.delete("img.v2")
+    assert list(store.keys()) == ["img"]
+
+
+def test_helpers_take_filenames(labeldir):
+    save_label(labeldir, "frame.v2.jpg", make_label(3))
+    assert label_exists(labeldir, "frame.v2.png", 3)
+    assert list(open_store(labeldir).keys()) == ["frame.v2"]
+    np.testing.assert_array_equal(
+        retrieve_label(labeldir, "frame.v2.jpg"), make_label(3)
+    )